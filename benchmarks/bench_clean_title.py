@@ -0,0 +1,120 @@
+"""
+Micro-benchmark for clean_title over a synthetic corpus of track titles.
+
+    python benchmarks/bench_clean_title.py [--count 100000] [--seed 1]
+
+First checks that the precompiled normalizer returns exactly what the
+original per-keyword re.sub implementation returned for every title, then
+times the original, the new function without its cache, and the cached one.
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import meloday
+
+
+def legacy_clean_title(title):
+    version_keywords = [
+        "extended", "deluxe", "remaster", "remastered", "live", "acoustic", "edit",
+        "version", "anniversary", "special edition", "radio edit", "album version",
+        "original mix", "remix", "mix", "dub", "instrumental", "karaoke", "cover",
+        "rework", "re-edit", "bootleg", "vip", "session", "alternate", "take",
+        "mix cut", "cut", "dj mix"
+    ]
+
+    featuring_patterns = [
+        r"\(feat\.?.*?\)", r"\[feat\.?.*?\]", r"\(ft\.?.*?\)", r"\[ft\.?.*?\]",
+        r"\bfeat\.?\s+\w+", r"\bfeaturing\s+\w+", r"\bft\.?\s+\w+",
+        r" - .*mix$", r" - .*dub$", r" - .*remix$", r" - .*edit$", r" - .*version$"
+    ]
+
+    title_clean = title.lower().strip()
+
+    for pattern in featuring_patterns:
+        title_clean = re.sub(pattern, '', title_clean, flags=re.IGNORECASE).strip()
+
+    for keyword in version_keywords:
+        title_clean = re.sub(rf"\b{keyword}\b", "", title_clean, flags=re.IGNORECASE).strip()
+
+    title_clean = re.sub(r"[\s-]+$", "", title_clean)  # Trim trailing spaces or hyphens
+    return title_clean
+
+
+WORDS = [
+    "Love", "Night", "Dream", "Fire", "Heart", "City", "Lights", "Summer", "Rain",
+    "Blue", "Gold", "Edition", "Remixed", "Cutting", "Taken", "Mixer", "Live-Wire",
+    "Über", "Café", "Ólafur", "東京", "Don't", "Rock'n'Roll", "A", "The", "Of",
+]
+KEYWORDS = [
+    "Extended", "Deluxe", "Remaster", "Remastered", "Live", "Acoustic", "Edit",
+    "Version", "Anniversary", "Special Edition", "Radio Edit", "Album Version",
+    "Original Mix", "Remix", "Mix", "Dub", "Instrumental", "Karaoke", "Cover",
+    "Rework", "Re-Edit", "Bootleg", "VIP", "Session", "Alternate", "Take",
+    "Mix Cut", "Cut", "DJ Mix", "2011 Remaster", "Club Mix", "Live at Wembley",
+]
+ARTISTS = ["Drake", "Sia", "MØ", "Daft Punk", "The Weeknd", "Florence + The Machine"]
+
+
+def synthetic_title(rng):
+    title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 5)))
+    roll = rng.random()
+    if roll < 0.15:
+        title += f" (feat. {rng.choice(ARTISTS)})"
+    elif roll < 0.25:
+        title += f" [ft {rng.choice(ARTISTS)}]"
+    elif roll < 0.3:
+        title += f" featuring {rng.choice(ARTISTS)}"
+    roll = rng.random()
+    if roll < 0.3:
+        title += f" ({rng.choice(KEYWORDS)})"
+    elif roll < 0.5:
+        title += f" - {rng.choice(KEYWORDS)}"
+    elif roll < 0.55:
+        title += f" [{rng.choice(KEYWORDS)}] -"
+    if rng.random() < 0.1:
+        title = f"  {title.upper()}  "
+    return title
+
+
+def timed(func, titles):
+    start = time.perf_counter()
+    for title in titles:
+        func(title)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--count", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    titles = [synthetic_title(rng) for _ in range(args.count)]
+    uncached = meloday.clean_title.__wrapped__
+
+    mismatches = [t for t in titles if uncached(t) != legacy_clean_title(t)]
+    if mismatches:
+        for title in mismatches[:10]:
+            print(f"MISMATCH {title!r}: {uncached(title)!r} != {legacy_clean_title(title)!r}")
+        sys.exit(f"{len(mismatches)} of {len(titles)} titles differ from the original clean_title")
+
+    meloday.clean_title.cache_clear()
+    legacy = timed(legacy_clean_title, titles)
+    compiled = timed(uncached, titles)
+    cached = timed(meloday.clean_title, titles)
+
+    print(f"{len(titles)} titles ({len(set(titles))} unique), output identical")
+    print(f"original : {legacy:8.3f}s")
+    print(f"compiled : {compiled:8.3f}s  ({legacy / compiled:5.1f}x)")
+    print(f"cached   : {cached:8.3f}s  ({legacy / cached:5.1f}x)  {meloday.clean_title.cache_info()}")
+
+
+if __name__ == "__main__":
+    main()
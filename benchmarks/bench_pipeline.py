@@ -0,0 +1,371 @@
+"""
+End-to-end pipeline benchmark against the in-process Plex stand-in.
+
+    python benchmarks/bench_pipeline.py [--sizes 1000 10000 100000 500000]
+        [--latency-ms 0] [--recording recording.json] [--update]
+        [--sonic-index] [--candidate-source server]
+        [--json results.json] [--baseline previous.json]
+
+Runs one playlist build per library size and reports, per stage, the wall
+time and the number of requests a real server would have received. Stage
+times are exclusive: a stage called from inside another one (process_tracks
+from fetch_sonically_similar_tracks) is not counted twice.
+sort_by_sonic_similarity_greedy, the greedy ordering meloday used before
+sequence_tracks, is kept here as a reference: it is run separately on the
+final tracks with an empty neighbor cache.
+
+With --sonic-index, the offline sonic index is built first (reported as its
+own pass) and the pipeline reads neighbors from it. --candidate-source
+server has the stand-in apply the rating and last-played exclusions.
+
+With --baseline, the run fails when a stage makes more requests than the
+baseline or is slower by more than --tolerance.
+
+Before benchmarking, check_tag_loading makes sure genres and moods really
+come through: from a plexapi Track parsed from XML, and through load_tags
+for the partial search records of the stand-in.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from functools import partial
+from xml.etree import ElementTree
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import meloday  # noqa: E402
+from plex_standin import RecordedLibrary, StandInServer, SyntheticLibrary  # noqa: E402
+
+STAGES = [
+    "fetch_play_history",
+    "fetch_historical_tracks",
+    "fetch_sonically_similar_tracks",
+    "process_tracks",
+    "SonicFrontier.expand",
+    "SonicFrontier.candidates",
+    "sequence_tracks",
+    "create_or_update_playlist",
+]
+
+
+class StageRecorder:
+    """
+    Wraps meloday's stage functions and accumulates exclusive wall time and
+    request counts per stage.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.seconds = defaultdict(float)
+        self.requests = defaultdict(int)
+        self.calls = defaultdict(int)
+        self._stack = []
+        self._originals = {}
+
+    def _enter(self, name):
+        now = time.perf_counter(), self.server.request_count
+        if self._stack:
+            self._charge(self._stack[-1], now)
+        self._stack.append([name, now])
+
+    def _exit(self):
+        now = time.perf_counter(), self.server.request_count
+        self._charge(self._stack.pop(), now)
+        if self._stack:
+            self._stack[-1][1] = now
+
+    def _charge(self, frame, now):
+        name, (start, start_requests) = frame
+        self.seconds[name] += now[0] - start
+        self.requests[name] += now[1] - start_requests
+
+    def wrap(self, name):
+        # "Class.method" wraps a method, anything else a module function
+        owner, attribute = (getattr(meloday, name.split(".")[0]), name.split(".")[1]) if "." in name else (meloday, name)
+        original = getattr(owner, attribute)
+        self._originals[name] = (owner, attribute, original)
+
+        def timed(*args, **kwargs):
+            self.calls[name] += 1
+            self._enter(name)
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self._exit()
+
+        setattr(owner, attribute, timed)
+
+    def __enter__(self):
+        for name in STAGES:
+            self.wrap(name)
+        return self
+
+    def __exit__(self, *exc):
+        for owner, attribute, original in self._originals.values():
+            setattr(owner, attribute, original)
+
+
+TRACK_XML = (
+    '<Track type="track" ratingKey="1" parentRatingKey="2" grandparentRatingKey="3" title="Song" '
+    'grandparentTitle="Artist"><Genre tag="Rock"/><Genre tag="Pop"/><Mood tag="Calm"/></Track>'
+)
+
+
+def check_tag_loading(source, workdir):
+    """
+    Return a list of problems with how track tags reach meloday's records.
+    """
+    from plexapi.audio import Track
+
+    problems = []
+    # A multi-key response item, with no server: reading it must not reload
+    track = Track(None, ElementTree.fromstring(TRACK_XML), initpath="/library/metadata/1,4")
+    record = meloday.TrackRecord.from_plex(track)
+    if record.genres != ("Rock", "Pop") or record.moods != ("Calm",):
+        problems.append(f"plexapi Track tags read as {record.genres} / {record.moods}")
+
+    server = StandInServer(source)
+    ctx = make_context(server, workdir, candidate_source="server")
+    key = next(iter(source.track_keys()))
+    neighbors = [neighbor for neighbor, _ in meloday.fetch_nearest(ctx, key, 50, 1.0)]
+    records = list(meloday.search_tracks_by_key(ctx, neighbors).values())
+    if not records or any(r.genres is not None for r in records):
+        problems.append("server-side search records should come back without tags")
+    meloday.load_tags(ctx, records)
+    for r in records:
+        expected = source.track(r.ratingKey)
+        if r.genres != tuple(expected["genres"]) or r.moods != tuple(expected["moods"]):
+            problems.append(f"load_tags filled {r.ratingKey} with {r.genres} / {r.moods}")
+            break
+    if server.requests.get("reload"):
+        problems.append(f"{server.requests['reload']} tracks were reloaded one by one")
+    return problems
+
+
+def make_context(server, workdir, sonic_index=False, candidate_source="client"):
+    ctx = meloday.MelodayContext(meloday.load_config(os.path.join(REPO_DIR, "config.yml")), plex=server)
+    ctx.state_path = os.path.join(workdir, "state.json")
+    ctx.history_db_path = os.path.join(workdir, "history.db")
+    ctx.cover_cache_dir = os.path.join(workdir, "covers")
+    ctx.metrics_format = "none"
+    ctx.candidate_source = candidate_source
+    ctx.sonic_index = meloday.SonicIndex(os.path.join(workdir, "sonic_index.npy") if sonic_index else None)
+    ctx.sonic_graph = meloday.SonicNeighborGraph(index=ctx.sonic_index, fetch=partial(meloday.fetch_nearest, ctx))
+    ctx.max_requests_per_second = 0
+    ctx.request_limiter = meloday.RateLimiter(0)
+    return ctx
+
+
+def sort_by_sonic_similarity_greedy(tracks, graph):
+    """
+    Greedy nearest-neighbor ordering, the reference for sequence_tracks.
+    Neighbor lists come from the graph (records have no sonicallySimilar of
+    their own, so it must have a fetch), so at most len(tracks) /nearest
+    requests are made.
+    """
+    if len(tracks) < 2:
+        return tracks
+    remaining = list(tracks)
+    sorted_list = []
+    start_index = random.randrange(len(remaining))
+    current = remaining.pop(start_index)
+    sorted_list.append(current)
+    while remaining:
+        next_track = min(
+            remaining,
+            key=lambda candidate: graph.rank(current, candidate)
+        )
+        sorted_list.append(next_track)
+        remaining.remove(next_track)
+        current = next_track
+    return sorted_list
+
+
+def run_pipeline(ctx, period):
+    """
+    The body of meloday.main for one period, with a fixed period.
+    """
+    history = meloday.fetch_play_history(ctx)
+    tracks = meloday.build_playlist_tracks(ctx, period, history)
+    title, description = meloday.generate_playlist_title_and_description(ctx, period, tracks)
+    meloday.create_or_update_playlist(ctx, title, tracks, description, ctx.time_periods[period]["cover"])
+    return tracks
+
+
+def run_pass(server, workdir, period, seed, verbose, sonic_index=False, candidate_source="client"):
+    ctx = make_context(server, workdir, sonic_index, candidate_source)
+    random.seed(seed)
+    server.reset_counters()
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+    start = time.perf_counter()
+    with StageRecorder(server) as recorder, output:
+        tracks = run_pipeline(ctx, period)
+    total = time.perf_counter() - start
+    requests = server.request_count
+    response_bytes = server.response_bytes
+
+    stages = {
+        name: {
+            "seconds": recorder.seconds[name],
+            "requests": recorder.requests[name],
+            "calls": recorder.calls[name],
+        }
+        for name in STAGES
+    }
+
+    server.reset_counters()
+    graph = meloday.SonicNeighborGraph(ctx.sonic_similar_limit, fetch=partial(meloday.fetch_nearest, ctx))
+    start = time.perf_counter()
+    sort_by_sonic_similarity_greedy(tracks, graph)
+    stages["sort_by_sonic_similarity_greedy"] = {
+        "seconds": time.perf_counter() - start,
+        "requests": server.request_count,
+        "calls": 1,
+    }
+
+    return {
+        "tracks": len(tracks),
+        "seconds": total,
+        "requests": requests,
+        "response_bytes": response_bytes,
+        "endpoints": dict(server.requests),
+        "stages": stages,
+    }
+
+
+def build_index(server, workdir, verbose):
+    ctx = make_context(server, workdir, sonic_index=True)
+    server.reset_counters()
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    start = time.perf_counter()
+    with output:
+        meloday.build_sonic_index(ctx, full=True)
+    seconds = time.perf_counter() - start
+    row = {"seconds": seconds, "requests": server.request_count, "calls": 1}
+    return {
+        "tracks": len(ctx.sonic_index.records()),
+        "seconds": seconds,
+        "requests": server.request_count,
+        "response_bytes": server.response_bytes,
+        "endpoints": dict(server.requests),
+        "stages": {"build_sonic_index": row},
+    }
+
+
+def benchmark(source, label, args):
+    server = StandInServer(source, latency=args.latency_ms / 1000.0)
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.sonic_index:
+            results["index"] = build_index(server, workdir, args.verbose)
+        results["cold"] = run_pass(
+            server, workdir, args.period, args.seed, args.verbose, args.sonic_index, args.candidate_source
+        )
+        if args.update:
+            # Same server and state: the playlist exists and is synced in place
+            results["update"] = run_pass(
+                server, workdir, args.period, args.seed + 1, args.verbose, args.sonic_index,
+                args.candidate_source
+            )
+    return label, results
+
+
+def print_results(label, results):
+    for name, result in results.items():
+        print(
+            f"\n{label} [{name}] {result['tracks']} tracks, {result['seconds']:.2f}s, "
+            f"{result['requests']} requests, ~{result['response_bytes'] / 1e6:.1f} MB"
+        )
+        print(f"  {'stage':<34}{'calls':>6}{'ms':>10}{'requests':>10}")
+        for stage, row in result["stages"].items():
+            print(f"  {stage:<34}{row['calls']:>6}{row['seconds'] * 1000:>10.1f}{row['requests']:>10}")
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for label, passes in results.items():
+        for name, result in passes.items():
+            base = baseline.get(label, {}).get(name)
+            if not base:
+                continue
+            for stage, row in result["stages"].items():
+                base_row = base["stages"].get(stage)
+                if not base_row:
+                    continue
+                if row["requests"] > base_row["requests"]:
+                    regressions.append(
+                        f"{label} [{name}] {stage}: {base_row['requests']} -> {row['requests']} requests"
+                    )
+                # Ignore noise on stages that take only a few milliseconds
+                if row["seconds"] > max(base_row["seconds"] * tolerance, base_row["seconds"] + 0.01):
+                    regressions.append(
+                        f"{label} [{name}] {stage}: {base_row['seconds'] * 1000:.1f} -> "
+                        f"{row['seconds'] * 1000:.1f} ms"
+                    )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the meloday pipeline against a Plex stand-in.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 500_000])
+    parser.add_argument("--recording", help="replay a recording made with plex_standin.py record")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated latency per request")
+    parser.add_argument("--period", default="Morning")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--update", action="store_true", help="also time a second run that updates the playlist")
+    parser.add_argument("--sonic-index", action="store_true", help="build the offline sonic index and use it")
+    parser.add_argument(
+        "--candidate-source", choices=["client", "server"], default="client",
+        help="where low-rated and recently played candidates are filtered out"
+    )
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="compare against results written earlier with --json")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="allowed slowdown factor per stage")
+    parser.add_argument("--verbose", action="store_true", help="show meloday's own output")
+    args = parser.parse_args()
+
+    if args.recording:
+        sources = [(RecordedLibrary.load(args.recording), os.path.basename(args.recording))]
+    else:
+        sources = [(SyntheticLibrary(size, seed=args.seed), f"{size} tracks") for size in args.sizes]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        problems = check_tag_loading(sources[0][0], workdir)
+    if problems:
+        print("Tag loading is broken:")
+        for problem in problems:
+            print(f"  {problem}")
+        sys.exit(1)
+
+    results = {}
+    for source, label in sources:
+        label, passes = benchmark(source, label, args)
+        results[label] = passes
+        print_results(label, passes)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nNo regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
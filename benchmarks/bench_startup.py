@@ -0,0 +1,59 @@
+"""
+Startup benchmark: how long `import meloday` takes in a fresh interpreter.
+
+    python benchmarks/bench_startup.py [--runs 10]
+
+Importing must not read config.yml or contact Plex, so this runs without a
+server. Also reports the time to build a MelodayContext from config.yml,
+which still does not connect.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = """
+import time
+start = time.perf_counter()
+import meloday
+print(time.perf_counter() - start)
+"""
+
+CONTEXT_SNIPPET = """
+import time
+import meloday
+start = time.perf_counter()
+ctx = meloday.MelodayContext.from_config_file()
+assert ctx._plex is None
+print(time.perf_counter() - start)
+"""
+
+
+def measure(snippet, runs):
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c", snippet], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        )
+        samples.append(float(result.stdout.strip()))
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    for label, snippet in (("import meloday", IMPORT_SNIPPET), ("MelodayContext", CONTEXT_SNIPPET)):
+        samples = measure(snippet, args.runs)
+        print(
+            f"{label:15s} median {statistics.median(samples) * 1000:7.1f} ms  "
+            f"min {min(samples) * 1000:7.1f} ms  ({args.runs} runs)"
+        )
+
+
+if __name__ == "__main__":
+    main()
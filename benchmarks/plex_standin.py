@@ -0,0 +1,686 @@
+"""
+In-process stand-in for the parts of the Plex API meloday uses: play
+history, sonicallySimilar, fetchItem/fetchItems, section searches, playlists
+and poster upload.
+
+It serves either a synthetic library of any size, generated lazily from a
+seed so 500k tracks cost no memory up front, or a recording of a real
+server made with:
+
+    python benchmarks/plex_standin.py record --out recording.json
+
+Every call that would be an HTTP request against a real server is counted
+per endpoint, together with an estimate of the bytes a server would send.
+Objects returned by sonicallySimilar are partial, like their plexapi
+counterparts: they carry no tags, and reading an empty or unset field
+(genres, an unrated track's userRating, an unplayed track's lastViewedAt)
+triggers a counted reload. As in plexapi, tags are parsed from the
+response on first read rather than stored on the object, and items of a
+multi-key response reload the same way when a field is empty.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from functools import cached_property
+from datetime import datetime, timedelta
+from urllib.parse import parse_qsl
+
+PAGE_SIZE = 100          # plexapi's default X-Plex-Container-Size
+ITEM_BYTES = 1500        # rough size of one track element in a Plex XML response
+EMPTY_BYTES = 200        # MediaContainer envelope of a response without items
+
+ALBUM_OFFSET = 10_000_000
+ARTIST_OFFSET = 20_000_000
+PLAYLIST_OFFSET = 30_000_000
+ADDED_BASE = datetime(2020, 1, 1)   # synthetic track N is added N minutes after this
+DEFAULT_MAX_DISTANCE = 0.25         # what /nearest uses without maxDistance
+NEIGHBOR_POOL = 60                  # synthetic neighbors per track before limit is applied
+TRACK_FIELDS = (
+    "title", "parentRatingKey", "grandparentRatingKey", "grandparentTitle", "userRating",
+    "genres", "moods", "lastViewedAt", "addedAt", "updatedAt",
+)
+
+GENRES = [
+    "Rock", "Pop", "Jazz", "Indie", "Electronic", "Folk", "Hip-Hop", "Soul",
+    "Ambient", "Classical", "Metal", "R&B", "Country", "Funk", "House", "Lo-Fi",
+]
+MOODS = [
+    "Mellow", "Upbeat", "Brooding", "Cheerful", "Quirky", "Calm", "Energetic",
+    "Melancholy", "Dreamy", "Aggressive", "Romantic", "Playful",
+]
+WORDS = [
+    "Love", "Night", "Dream", "Fire", "Heart", "City", "Lights", "Summer", "Rain",
+    "Blue", "Gold", "Ocean", "Echo", "Shadow", "River", "Star", "Road", "Home",
+]
+SUFFIXES = ["", "", "", "", " (Live)", " - Remix", " (feat. Someone)", " (2011 Remaster)", " - Radio Edit"]
+
+
+class Tag:
+    def __init__(self, tag):
+        self.tag = tag
+
+    def __str__(self):
+        return self.tag
+
+    def __repr__(self):
+        return f"<Tag:{self.tag}>"
+
+
+# ---------------------------------------------------------------------
+# Library sources
+class SyntheticLibrary:
+    """
+    Deterministic synthetic library. Tracks are grouped ten to an album and
+    five albums to an artist; every attribute and neighbor list is derived
+    from the ratingKey and the seed, so nothing is stored per track.
+    """
+    def __init__(self, size, seed=0, plays=None, history_days=365, neighbor_spread=200):
+        self.size = size
+        self.seed = seed
+        self.neighbor_spread = neighbor_spread
+        self.history = self._generate_history(plays or min(max(size // 10, 200), 20_000), history_days)
+        self.last_viewed = {}
+        for key, viewed_at in self.history:
+            if viewed_at > self.last_viewed.get(key, datetime.min):
+                self.last_viewed[key] = viewed_at
+
+    def _rng(self, *parts):
+        # String seeds are hashed with SHA-512, so this is stable across runs
+        return random.Random(":".join(map(str, (self.seed,) + parts)))
+
+    def _generate_history(self, plays, days):
+        rng = self._rng("history")
+        now = datetime.now()
+        history = []
+        for _ in range(plays):
+            # Skew plays towards a popular part of the library
+            key = int(self.size * rng.random() ** 2) + 1
+            viewed_at = now - timedelta(seconds=rng.randrange(days * 86400))
+            history.append((key, viewed_at))
+        history.sort(key=lambda play: play[1], reverse=True)
+        return history
+
+    def track(self, key):
+        if not 1 <= key <= self.size:
+            return None
+        rng = self._rng("track", key)
+        album = (key - 1) // 10 + 1
+        artist = (album - 1) // 5 + 1
+        roll = rng.random()
+        return {
+            "ratingKey": key,
+            "title": " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))) + rng.choice(SUFFIXES),
+            "parentRatingKey": ALBUM_OFFSET + album,
+            "grandparentRatingKey": ARTIST_OFFSET + artist,
+            "grandparentTitle": f"Artist {artist}",
+            "userRating": 2.0 if roll < 0.05 else 8.0 if roll < 0.25 else None,
+            "genres": [GENRES[artist % len(GENRES)], GENRES[(artist * 7 + album) % len(GENRES)]],
+            "moods": rng.sample(MOODS, 2),
+            "lastViewedAt": self.last_viewed.get(key),
+            "addedAt": ADDED_BASE + timedelta(minutes=key),
+            "updatedAt": ADDED_BASE + timedelta(minutes=key),
+        }
+
+    def track_keys(self, since=None):
+        first = 1
+        if since is not None:
+            first = max(1, int((since - ADDED_BASE).total_seconds() // 60) + 1)
+        return range(first, self.size + 1)
+
+    def album(self, key):
+        album = key - ALBUM_OFFSET
+        if not 1 <= album <= (self.size - 1) // 10 + 1:
+            return None
+        rng = self._rng("album", album)
+        return {"ratingKey": key, "title": f"Album {album}", "userRating": 2.0 if rng.random() < 0.03 else None}
+
+    def artist(self, key):
+        artist = key - ARTIST_OFFSET
+        if not 1 <= artist <= (self.size - 1) // 50 + 1:
+            return None
+        rng = self._rng("artist", artist)
+        return {"ratingKey": key, "title": f"Artist {artist}", "userRating": 2.0 if rng.random() < 0.02 else None}
+
+    def neighbors(self, key, limit):
+        """
+        [(ratingKey, distance)] nearest first. Distance grows with the
+        distance between ratingKeys, so neighborhoods overlap like real ones.
+        """
+        rng = self._rng("neighbors", key)
+        neighbors = {}
+        # Draw a fixed pool so a smaller limit returns a prefix of a larger one
+        while len(neighbors) < min(NEIGHBOR_POOL, self.size - 1):
+            offset = int(rng.gauss(0, self.neighbor_spread))
+            other = (key - 1 + offset) % self.size + 1
+            if other != key and other not in neighbors:
+                neighbors[other] = min(1.0, abs(offset) / (4 * self.neighbor_spread))
+        return sorted(neighbors.items(), key=lambda neighbor: neighbor[1])[:limit]
+
+
+class RecordedLibrary:
+    """
+    Library replayed from a recording. Tracks that were not recorded do not
+    exist, and only recorded tracks have sonic neighbors.
+    """
+    def __init__(self, data):
+        self.tracks = {int(key): track for key, track in data["tracks"].items()}
+        self.albums = {int(key): album for key, album in data["albums"].items()}
+        self.artists = {int(key): artist for key, artist in data["artists"].items()}
+        self.neighbor_lists = {int(key): keys for key, keys in data["neighbors"].items()}
+        self.history = [(key, datetime.fromtimestamp(viewed_at)) for key, viewed_at in data["history"]]
+        self.size = len(self.tracks)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as file:
+            return cls(json.load(file))
+
+    def track(self, key):
+        track = self.tracks.get(key)
+        if track is None:
+            return None
+        track = dict(track)
+        for field in ("lastViewedAt", "addedAt", "updatedAt"):
+            if track.get(field):
+                track[field] = datetime.fromtimestamp(track[field])
+        return track
+
+    def track_keys(self, since=None):
+        if since is None:
+            return sorted(self.tracks)
+        stamp = since.timestamp()
+        return sorted(
+            key for key, track in self.tracks.items()
+            if max(track.get("addedAt") or 0, track.get("updatedAt") or 0) > stamp
+        )
+
+    def album(self, key):
+        return self.albums.get(key)
+
+    def artist(self, key):
+        return self.artists.get(key)
+
+    def neighbors(self, key, limit):
+        return [tuple(neighbor) for neighbor in self.neighbor_lists.get(key, [])[:limit]]
+
+
+# ---------------------------------------------------------------------
+# Plex objects
+class StandInItem:
+    TYPE = None
+
+    def __init__(self, server, data):
+        self._server = server
+        self.__dict__.update(data)
+        self.key = f"/library/metadata/{self.ratingKey}"
+
+    def __eq__(self, other):
+        if isinstance(other, StandInItem):
+            return self.key == other.key
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}:{self.ratingKey}:{getattr(self, 'title', '')}>"
+
+
+class StandInAlbum(StandInItem):
+    TYPE = "album"
+
+
+class StandInArtist(StandInItem):
+    TYPE = "artist"
+
+
+class StandInTrack(StandInItem):
+    TYPE = "track"
+    listType = "audio"
+
+    def __init__(self, server, data, partial=False, auto_reload=True, detail=True):
+        self._auto_reload = auto_reload
+        # plexapi only treats objects loaded from their own details path as
+        # full, so items of a multi-key response reload like partial ones
+        self._reloadable = partial or not detail
+        data = dict(data)
+        # Like plexapi's cached_data_property, tags stay in the raw response
+        # and are only parsed into the instance on first read
+        self._tag_data = {field: data.pop(field, None) or [] for field in ("genres", "moods")}
+        if partial:
+            # Partial responses carry no tags, and unset fields read as missing
+            self._tag_data = {}
+            data = {key: value for key, value in data.items() if value is not None}
+        super().__init__(server, data)
+
+    def __getattribute__(self, name):
+        # Like plexapi, reading an empty or unset field of a partial object reloads it
+        value = super().__getattribute__(name)
+        if (
+            value in (None, []) and name in TRACK_FIELDS
+            and super().__getattribute__("_reloadable") and super().__getattribute__("_auto_reload")
+        ):
+            self.reload()
+            value = super().__getattribute__(name)
+        return value
+
+    def __getattr__(self, name):
+        if name in TRACK_FIELDS:
+            return None
+        raise AttributeError(name)
+
+    @cached_property
+    def genres(self):
+        return [Tag(tag) for tag in self._tag_data.get("genres", [])]
+
+    @cached_property
+    def moods(self):
+        return [Tag(tag) for tag in self._tag_data.get("moods", [])]
+
+    def reload(self):
+        data = self._server._track_data(self.ratingKey)
+        self._server._request("reload", 1)
+        self._auto_reload = False
+        self._tag_data = {field: data.get(field) or [] for field in ("genres", "moods")}
+        for field in ("genres", "moods"):
+            self.__dict__.pop(field, None)
+        for field in TRACK_FIELDS:
+            if field not in ("genres", "moods") and self.__dict__.get(field) is None:
+                self.__dict__[field] = data.get(field)
+        return self
+
+    def sonicallySimilar(self, limit=None, maxDistance=None, **kwargs):
+        return self._server._nearest(self.ratingKey, limit or 50, maxDistance)
+
+    def artist(self):
+        return self._server.fetchItem(self.grandparentRatingKey)
+
+
+class StandInPlaylist(StandInItem):
+    TYPE = "playlist"
+
+    def __init__(self, server, ratingKey, title, items):
+        super().__init__(server, {"ratingKey": ratingKey, "title": title, "summary": ""})
+        self.key = f"/playlists/{ratingKey}"
+        self._contents = []
+        self._items = None
+        self._add(items)
+
+    def _add(self, items):
+        # Each entry is its own track object with a playlistItemID, like Plex's
+        for item in items:
+            entry = StandInTrack(self._server, self._server._track_data(item.ratingKey))
+            self._server._playlist_item_ids += 1
+            entry.playlistItemID = self._server._playlist_item_ids
+            self._contents.append(entry)
+
+    def items(self):
+        if self._items is None:
+            self._server._request("playlist.items", len(self._contents))
+            self._items = list(self._contents)
+        return self._items
+
+    def reload(self):
+        self._server._request("playlist.reload", 0)
+        self._items = None
+        return self
+
+    def addItems(self, items):
+        self._server._request("playlist.add", 0)
+        self._add(items)
+        return self
+
+    def removeItems(self, items):
+        # Like plexapi: each item is matched to an entry by ratingKey
+        for item in items:
+            entry = next((e for e in self.items() if e.ratingKey == item.ratingKey), None)
+            if entry is None:
+                raise LookupError(f"Item {item.ratingKey} not found in the playlist")
+            self._delete_entry(entry.playlistItemID)
+        return self
+
+    def _delete_entry(self, playlist_item_id):
+        self._server._request("playlist.remove", 0)
+        if not any(e.playlistItemID == playlist_item_id for e in self._contents):
+            raise LookupError(f"Playlist item {playlist_item_id} not found")
+        self._contents = [e for e in self._contents if e.playlistItemID != playlist_item_id]
+
+    def moveItem(self, item, after=None):
+        self._server._request("playlist.move", 0)
+        self._contents = [i for i in self._contents if i.ratingKey != item.ratingKey]
+        index = 0 if after is None else [i.ratingKey for i in self._contents].index(after.ratingKey) + 1
+        self._contents.insert(index, item)
+        return self
+
+    def editTitle(self, title):
+        self._server._request("playlist.edit", 0)
+        self.title = title
+
+    def editSummary(self, summary):
+        self._server._request("playlist.edit", 0)
+        self.summary = summary
+
+    def uploadPoster(self, url=None, filepath=None):
+        self._server._request("playlist.poster", 0)
+        self._server.uploaded_bytes += os.path.getsize(filepath) if filepath else 0
+
+
+class StandInResponse:
+    def __init__(self, endpoint, size):
+        self.url = endpoint
+        self.status_code = 200
+        self.headers = {"Content-Length": str(size)}
+        self.content = b""
+
+
+class StandInSession:
+    """
+    Holds response hooks like a requests.Session, so meloday's metrics see
+    the stand-in's requests.
+    """
+    def __init__(self):
+        self.hooks = {"response": []}
+
+    def delete(self, *args, **kwargs):
+        raise NotImplementedError("use StandInServer.query")
+
+
+class StandInAccount:
+    title = "Stand-in Listener"
+    username = "standin"
+
+
+class StandInSection:
+    def __init__(self, server, title):
+        self._server = server
+        self.title = title
+        self.key = 1
+
+    def history(self, maxresults=None, mindate=None):
+        plays = [
+            (key, viewed_at) for key, viewed_at in self._server.source.history
+            if mindate is None or viewed_at >= mindate
+        ][:maxresults]
+        self._server._request_pages("history", len(plays))
+        entries = []
+        for key, viewed_at in plays:
+            data = self._server._track_data(key)
+            if data is None:
+                continue
+            # plexapi never reloads history entries
+            entry = StandInTrack(self._server, data, partial=True, auto_reload=False)
+            entry.viewedAt = viewed_at
+            entries.append(entry)
+        return entries
+
+    def searchTracks(self, filters=None, container_start=None, container_size=None, maxresults=None, **kwargs):
+        """
+        All tracks, or with {"or": [{"addedAt>>": date}, {"updatedAt>>": date}]}
+        the ones added or updated after the date.
+        """
+        since = None
+        if filters:
+            dates = [value for part in filters.get("or", [filters]) for field, value in part.items()
+                     if field in ("addedAt>>", "updatedAt>>")]
+            if not dates:
+                raise NotImplementedError(f"Stand-in does not support filters {filters}")
+            since = min(dates)
+        keys = self._server.source.track_keys(since)
+        start = container_start or 0
+        keys = keys[start:start + maxresults] if maxresults is not None else keys[start:]
+        self._server._request_pages("search", len(keys))
+        return [item for item in (self._server._build(key, detail=False) for key in keys) if item is not None]
+
+
+class StandInLibrary:
+    def __init__(self, server):
+        self._server = server
+
+    def section(self, title):
+        self._server._request("library.sections", 1)
+        return StandInSection(self._server, title)
+
+
+class StandInServer:
+    """
+    Drop-in for plexapi's PlexServer as far as meloday is concerned. Pass it
+    as MelodayContext(config, plex=server). `requests` counts calls per
+    endpoint, `response_bytes` estimates the payload, and `latency` adds a
+    fixed delay per request to model a remote server.
+    """
+    def __init__(self, source, latency=0.0, page_size=PAGE_SIZE):
+        self.source = source
+        self.latency = latency
+        self.page_size = page_size
+        self.library = StandInLibrary(self)
+        self.requests = Counter()
+        self.response_bytes = 0
+        self.uploaded_bytes = 0
+        self._session = StandInSession()
+        self._playlists = {}
+        self._playlist_item_ids = 0
+        self._lock = threading.Lock()
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests.clear()
+            self.response_bytes = 0
+            self.uploaded_bytes = 0
+
+    @property
+    def request_count(self):
+        return sum(self.requests.values())
+
+    def _request(self, endpoint, items):
+        size = EMPTY_BYTES + items * ITEM_BYTES
+        with self._lock:
+            self.requests[endpoint] += 1
+            self.response_bytes += size
+        for hook in self._session.hooks["response"]:
+            hook(StandInResponse(endpoint, size))
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _request_pages(self, endpoint, items):
+        pages = max(1, -(-items // self.page_size))
+        for page in range(pages):
+            self._request(endpoint, min(self.page_size, items - page * self.page_size))
+
+    def _track_data(self, key):
+        return self.source.track(key)
+
+    def _build(self, key, partial=False, detail=True):
+        if key in self._playlists:
+            return self._playlists[key]
+        data = self.source.track(key)
+        if data is not None:
+            return StandInTrack(self, data, partial=partial, detail=detail)
+        data = self.source.album(key)
+        if data is not None:
+            return StandInAlbum(self, data)
+        data = self.source.artist(key)
+        if data is not None:
+            return StandInArtist(self, data)
+        return None
+
+    def _nearest(self, key, limit, max_distance=None):
+        max_distance = DEFAULT_MAX_DISTANCE if max_distance is None else max_distance
+        neighbors = [(k, d) for k, d in self.source.neighbors(key, limit) if d <= max_distance]
+        self._request("nearest", len(neighbors))
+        items = []
+        for neighbor, distance in neighbors:
+            item = self._build(neighbor, partial=True)
+            if item is not None:
+                item.distance = distance
+                items.append(item)
+        return items
+
+    def _search_by_key(self, query):
+        """
+        The section search meloday sends with candidate_source "server": an
+        id list, userRating!= filters on the track, album and artist, and
+        never played or last played before a timestamp.
+        """
+        params = dict(parse_qsl(query))
+        played_before = datetime.fromtimestamp(int(params["lastViewedAt<<"]))
+
+        def low(rating, field):
+            return rating is not None and str(int(rating)) in params.get(field, "").split(",")
+
+        items = []
+        for key in params["id"].split(","):
+            data = self.source.track(int(key))
+            if data is None or low(data.get("userRating"), "userRating!"):
+                continue
+            album = self.source.album(data["parentRatingKey"]) or {}
+            artist = self.source.artist(data["grandparentRatingKey"]) or {}
+            if low(album.get("userRating"), "album.userRating!") or low(artist.get("userRating"), "artist.userRating!"):
+                continue
+            if data.get("lastViewedAt") and data["lastViewedAt"] >= played_before:
+                continue
+            items.append(StandInTrack(self, data, partial=True))
+        self._request_pages("search", len(items))
+        return items
+
+    def fetchItems(self, ekey, **kwargs):
+        if isinstance(ekey, str):
+            match = re.match(r"^/library/sections/\d+/all\?(.*)$", ekey)
+            if match:
+                return self._search_by_key(match.group(1))
+            match = re.match(r"^/library/metadata/(\d+)/nearest(?:\?(.*))?$", ekey)
+            if match:
+                params = dict(part.split("=", 1) for part in (match.group(2) or "").split("&") if "=" in part)
+                max_distance = float(params["maxDistance"]) if "maxDistance" in params else None
+                return self._nearest(int(match.group(1)), int(params.get("limit", 50)), max_distance)
+            match = re.match(r"^/library/metadata/([\d,]+)$", ekey)
+            if not match:
+                raise NotImplementedError(f"Stand-in does not serve {ekey}")
+            ekey = [int(key) for key in match.group(1).split(",")]
+        items = [item for item in (self._build(int(key), detail=False) for key in ekey) if item is not None]
+        self._request_pages("metadata", len(items))
+        return items
+
+    def fetchItem(self, ekey, **kwargs):
+        if isinstance(ekey, str):
+            ekey = int(ekey.rsplit("/", 1)[-1])
+        self._request("metadata", 1)
+        item = self._build(int(ekey))
+        if item is None:
+            raise LookupError(f"Unable to find item {ekey}")
+        return item
+
+    def query(self, key, method=None, **kwargs):
+        match = re.match(r"^/playlists/(\d+)/items/(\d+)$", key)
+        if not match or method != self._session.delete:
+            raise NotImplementedError(f"Stand-in does not serve {key}")
+        self._playlists[int(match.group(1))]._delete_entry(int(match.group(2)))
+
+    def playlists(self, **kwargs):
+        self._request("playlists", len(self._playlists))
+        return list(self._playlists.values())
+
+    def createPlaylist(self, title, items=None, **kwargs):
+        self._request("playlists.create", 0)
+        ratingKey = PLAYLIST_OFFSET + len(self._playlists) + 1
+        playlist = StandInPlaylist(self, ratingKey, title, items or [])
+        self._playlists[ratingKey] = playlist
+        return playlist
+
+    def myPlexAccount(self):
+        self._request("plex.tv.account", 0)
+        return StandInAccount()
+
+
+# ---------------------------------------------------------------------
+# Recording
+def record(plex, music_library, history_days=30, neighbor_limit=50, batch_size=100):
+    """
+    Record what meloday needs from a real server: the play history of the
+    last history_days, the sonic neighbors of every played track, and the
+    metadata and ratings of all those tracks, albums and artists.
+    """
+    section = plex.library.section(music_library)
+    mindate = datetime.now() - timedelta(days=history_days)
+    history = [
+        (entry.ratingKey, int(entry.viewedAt.timestamp()))
+        for entry in section.history(mindate=mindate) if entry.viewedAt
+    ]
+
+    neighbors = {}
+    for key in sorted({key for key, _ in history}):
+        try:
+            neighbors[key] = [
+                [t.ratingKey, t.distance]
+                for t in plex.fetchItem(key).sonicallySimilar(limit=neighbor_limit, maxDistance=1.0)
+            ]
+        except Exception as e:
+            print(f"Skipping neighbors of {key}: {e}")
+
+    def fetch_all(keys):
+        keys = sorted(keys)
+        items = []
+        for i in range(0, len(keys), batch_size):
+            items.extend(plex.fetchItems(keys[i:i + batch_size]))
+        return items
+
+    track_keys = set(neighbors) | {k for keys in neighbors.values() for k, _ in keys}
+    tracks = {}
+    for track in fetch_all(track_keys):
+        tracks[track.ratingKey] = {
+            "ratingKey": track.ratingKey,
+            "title": track.title,
+            "parentRatingKey": track.parentRatingKey,
+            "grandparentRatingKey": track.grandparentRatingKey,
+            "grandparentTitle": track.grandparentTitle,
+            "userRating": track.userRating,
+            "genres": [str(g) for g in track.genres],
+            "moods": [str(m) for m in track.moods],
+            "lastViewedAt": int(track.lastViewedAt.timestamp()) if track.lastViewedAt else None,
+            "addedAt": int(track.addedAt.timestamp()) if track.addedAt else None,
+            "updatedAt": int(track.updatedAt.timestamp()) if track.updatedAt else None,
+        }
+
+    def parents(field):
+        keys = {track[field] for track in tracks.values() if track[field]}
+        return {
+            item.ratingKey: {"ratingKey": item.ratingKey, "title": item.title, "userRating": item.userRating}
+            for item in fetch_all(keys)
+        }
+
+    return {
+        "recorded_at": int(time.time()),
+        "tracks": tracks,
+        "albums": parents("parentRatingKey"),
+        "artists": parents("grandparentRatingKey"),
+        "neighbors": neighbors,
+        "history": history,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record a Plex library for the meloday stand-in.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record_parser = subparsers.add_parser("record", help="record responses from the server in config.yml")
+    record_parser.add_argument("--out", required=True)
+    record_parser.add_argument("--history-days", type=int, default=30)
+    record_parser.add_argument("--neighbor-limit", type=int, default=50)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import meloday
+
+    ctx = meloday.MelodayContext.from_config_file()
+    data = record(ctx.plex, ctx.music_library, args.history_days, args.neighbor_limit)
+    with open(args.out, "w", encoding="utf-8") as file:
+        json.dump(data, file)
+    print(f"Recorded {len(data['tracks'])} tracks and {len(data['history'])} plays to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
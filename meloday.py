@@ -2,11 +2,19 @@ import yaml
 import os
 import re
 import random
+import argparse
 import json
+import hashlib
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import lru_cache, partial
 from datetime import datetime, timedelta
-from collections import Counter
-from plexapi.server import PlexServer
-from plexapi.audio import Track
+from collections import Counter, defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
 from PIL import Image, ImageDraw, ImageFont, ImageFilter
 
 # Get the base directory of the script
@@ -16,32 +24,182 @@ def load_config(filepath="config.yml"):
     with open(os.path.join(BASE_DIR, filepath), "r", encoding="utf-8") as file:
         return yaml.safe_load(file)
 
-config = load_config()
+COVER_CACHE_SIZE = 50
 
-PLEX_URL = config["plex"]["url"]
-PLEX_TOKEN = config["plex"]["token"]
-MUSIC_LIBRARY = config["plex"]["music_library"]
-
-EXCLUDE_PLAYED_DAYS = config["playlist"]["exclude_played_days"]
-HISTORY_LOOKBACK_DAYS = config["playlist"]["history_lookback_days"]
-MAX_TRACKS = config["playlist"]["max_tracks"]
-SONIC_SIMILAR_LIMIT = config["playlist"]["sonic_similar_limit"]
-
-PERIOD_PHRASES = config["period_phrases"]
-def get_period_phrase(period):
-    return PERIOD_PHRASES.get(period, f"in the {period}")
-
-# Convert paths to be relative to BASE_DIR
-COVER_IMAGE_DIR = os.path.join(BASE_DIR, config["directories"]["cover_images"])
-MOOD_MAP_PATH = os.path.join(BASE_DIR, config["files"]["mood_map"])
-FONTS_DIR = os.path.join(BASE_DIR, config["directories"]["fonts"])
+# ---------------------------------------------------------------------
+class MelodayContext:
+    """
+    Configuration, Plex connection and per-run caches, passed explicitly to
+    the pipeline functions. Importing meloday does no I/O: the config is read
+    when a context is created and the server handshake only happens the first
+    time ctx.plex is used.
+    """
+    def __init__(self, config, plex=None):
+        self.config = config
+
+        self.plex_url = config["plex"]["url"]
+        self.plex_token = config["plex"]["token"]
+        self.music_library = config["plex"]["music_library"]
+
+        playlist = config["playlist"]
+        self.exclude_played_days = playlist["exclude_played_days"]
+        self.history_lookback_days = playlist["history_lookback_days"]
+        self.max_tracks = playlist["max_tracks"]
+        self.sonic_similar_limit = playlist["sonic_similar_limit"]
+        self.fetch_workers = playlist.get("fetch_workers", 1)
+        self.max_requests_per_second = playlist.get("max_requests_per_second", 0)
+        self.random_seed = playlist.get("seed")
+        self.sequencing_time_budget = playlist.get("sequencing_time_budget", 2.0)
+        self.expansion_request_budget = playlist.get("expansion_request_budget", 100)
+        self.playlist_sync_mode = playlist.get("sync_mode", "diff")
+        self.skip_unchanged = playlist.get("skip_unchanged", True)
+        self.candidate_source = playlist.get("candidate_source", "client")
+        self.cache_ttl = timedelta(minutes=config.get("daemon", {}).get("cache_ttl_minutes", 360))
+        http = config.get("http", {})
+        self.http_pool_size = http.get("pool_size") or max(10, self.fetch_workers)
+        self.http_timeout = (http.get("connect_timeout", 5), http.get("read_timeout", 60))
+        self.http_retries = http.get("retries", 3)
+        self.http_backoff = http.get("backoff", 0.5)
+        self.http_compression = http.get("compression", True)
+        metrics = config.get("metrics", {})
+        self.metrics_format = metrics.get("format") or "none"
+        self.metrics_path = os.path.join(BASE_DIR, metrics["path"]) if metrics.get("path") else None
+
+        self.time_periods = config["time_periods"]
+        self.period_phrases = config["period_phrases"]
+
+        # Convert paths to be relative to BASE_DIR
+        self.cover_image_dir = os.path.join(BASE_DIR, config["directories"]["cover_images"])
+        self.mood_map_path = os.path.join(BASE_DIR, config["files"]["mood_map"])
+        self.state_path = os.path.join(BASE_DIR, config["files"].get("state", "meloday_state.json"))
+        self.history_db_path = (
+            os.path.join(BASE_DIR, config["files"]["history_db"])
+            if config["files"].get("history_db") else None
+        )
+        fonts_dir = os.path.join(BASE_DIR, config["directories"]["fonts"])
+        self.font_main_path = os.path.join(fonts_dir, config["fonts"]["main"])
+        self.font_meloday_path = os.path.join(fonts_dir, config["fonts"]["meloday"])
+        cache_dir = os.path.join(BASE_DIR, config["directories"].get("cache", "cache"))
+        self.cover_cache_dir = os.path.join(cache_dir, "covers")
+        sonic_index = config.get("sonic_index", {})
+        self.sonic_index_neighbors = sonic_index.get("neighbors", 20)
+        self.sonic_index_max_distance = sonic_index.get("max_distance", 1.0)
+        self.sonic_index = SonicIndex(
+            os.path.join(BASE_DIR, sonic_index["path"]) if sonic_index.get("path") else None
+        )
 
-FONT_MAIN_PATH = os.path.join(FONTS_DIR, config["fonts"]["main"])
-FONT_MELODAY_PATH = os.path.join(FONTS_DIR, config["fonts"]["meloday"])
+        self.metrics = RunMetrics()
+        self._plex = plex
+        if plex is not None:
+            self.metrics.attach(getattr(plex, "_session", None))
+        self._music_section = None
+        self._history_store = None
+        self.rating_resolver = RatingResolver(self)
+        # Tracks loaded this run, shared by every period; cleared by main()
+        self.track_records = {}
+        self.searched_tracks = {}
+        self.request_limiter = RateLimiter(self.max_requests_per_second)
+        self.sonic_graph = SonicNeighborGraph(
+            index=self.sonic_index, limiter=self.request_limiter, fetch=partial(fetch_nearest, self)
+        )
+        self.plex_user = None
+
+    @classmethod
+    def from_config_file(cls, filepath="config.yml"):
+        return cls(load_config(filepath))
+
+    @property
+    def plex(self):
+        if self._plex is None:
+            from plexapi.server import PlexServer  # deferred: importing plexapi is slow
+            session = make_plex_session(self)
+            # Hook the session before the handshake, so that request is counted too
+            self.metrics.attach(session)
+            self._plex = PlexServer(self.plex_url, self.plex_token, session=session, timeout=self.http_timeout)
+        return self._plex
+
+    @property
+    def music_section(self):
+        if self._music_section is None:
+            self._music_section = self.plex.library.section(self.music_library)
+        return self._music_section
+
+    @property
+    def history_store(self):
+        # One SQLite connection for the life of the context, reused by every daemon cycle
+        if self._history_store is None:
+            self._history_store = HistoryStore(self.history_db_path)
+        return self._history_store
+
+    def evict_expired(self):
+        """
+        Drop cached neighbor lists and ratings older than the cache TTL, so a
+        long-running daemon picks up library changes.
+        """
+        cutoff = time.monotonic() - self.cache_ttl.total_seconds()
+        self.sonic_graph.evict_older_than(cutoff)
+        self.rating_resolver.evict_older_than(cutoff)
+        self.sonic_index.reopen_if_changed()
 
-time_periods = config["time_periods"]
+# ---------------------------------------------------------------------
+# Plex connection
+def make_plex_session(ctx):
+    """
+    requests session for the Plex server: a keep-alive pool with room for
+    every parallel fetcher, retries with exponential backoff for GETs only
+    (playlist edits are not idempotent and are never retried), and gzip
+    responses unless http.compression is off.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=ctx.http_retries,
+        backoff_factor=ctx.http_backoff,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET"}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=ctx.http_pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if not ctx.http_compression:
+        # requests asks for gzip by default; on a LAN, plain responses can be cheaper
+        session.headers["Accept-Encoding"] = "identity"
+    return session
+
+def http_pool_stats(plex):
+    """
+    Connections opened and requests sent per host since the session was
+    created, and connections idle in the pool right now. Many more requests
+    than connections means keep-alive is working.
+    """
+    session = getattr(plex, "_session", None)
+    adapters = getattr(session, "adapters", None) or {}
+    stats = {}
+    for adapter in {id(adapter): adapter for adapter in adapters.values()}.values():
+        pools = getattr(getattr(adapter, "poolmanager", None), "pools", None)
+        if pools is None:
+            continue
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            # The queue is pre-filled with None placeholders for unopened connections
+            idle = sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0
+            stats[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+                "idle_connections": idle,
+                "max_connections": pool.pool.maxsize if pool.pool is not None else 0,
+            }
+    return stats
 
-plex = PlexServer(PLEX_URL, PLEX_TOKEN, timeout=60)
+# ---------------------------------------------------------------------
+def get_period_phrase(ctx, period):
+    return ctx.period_phrases.get(period, f"in the {period}")
 
 
 # ---------------------------------------------------------------------
@@ -56,7 +214,158 @@ def print_status(percent, message):
     print(f"[{bar}] {percent:3d}%  {message}")
 
 # ---------------------------------------------------------------------
-def get_current_time_period():
+# Run metrics: wall time, Plex requests and bytes per stage, cache hits
+class RunMetrics:
+    """
+    Per-run instrumentation. Plex requests and response bytes are counted by
+    a response hook on plexapi's requests session, so requests made from
+    worker threads are included. Stages are timed with
+    `with ctx.metrics.stage(name):` and accumulate when they run more than
+    once (e.g. with --all-periods).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.retries = 0
+        self.reset()
+
+    def reset(self):
+        self.started_at = datetime.now()
+        self._start = time.perf_counter()
+        self._requests_at_start = self.requests
+        self._bytes_at_start = self.bytes
+        self._retries_at_start = self.retries
+        self.stages = {}
+        self.caches = {}
+        self.periods = []
+
+    def attach(self, session):
+        if session is not None:
+            session.hooks.setdefault("response", []).append(self.record_response)
+
+    def record_response(self, response, *args, **kwargs):
+        length = response.headers.get("Content-Length")
+        size = int(length) if length else len(response.content or b"")
+        retries = getattr(getattr(response, "raw", None), "retries", None)
+        with self._lock:
+            self.requests += 1
+            self.bytes += size
+            self.retries += len(retries.history) if retries else 0
+
+    @contextmanager
+    def stage(self, name):
+        start, requests, transferred = time.perf_counter(), self.requests, self.bytes
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "requests": 0, "bytes": 0})
+            stage["calls"] += 1
+            stage["seconds"] += time.perf_counter() - start
+            stage["requests"] += self.requests - requests
+            stage["bytes"] += self.bytes - transferred
+
+    def count_cache(self, name, hits=0, misses=0):
+        counts = self.caches.setdefault(name, {"hits": 0, "misses": 0})
+        counts["hits"] += hits
+        counts["misses"] += misses
+
+    def record(self, http_pool=None):
+        return {
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "periods": self.periods,
+            "seconds": round(time.perf_counter() - self._start, 3),
+            "requests": self.requests - self._requests_at_start,
+            "bytes": self.bytes - self._bytes_at_start,
+            "retries": self.retries - self._retries_at_start,
+            "stages": {
+                name: dict(stage, seconds=round(stage["seconds"], 3)) for name, stage in self.stages.items()
+            },
+            "caches": self.caches,
+            "http_pool": http_pool or {},
+        }
+
+def cache_counters(ctx):
+    """
+    Cumulative (hits, misses) of the caches that live longer than one run.
+    main() records the difference between the start and the end of a run.
+    """
+    counters = {
+        "ratings": (ctx.rating_resolver.hits, ctx.rating_resolver.misses),
+        "sonic_neighbors": (ctx.sonic_graph.hits, ctx.sonic_graph.misses),
+        "sonic_index": (ctx.sonic_index.hits, ctx.sonic_index.misses),
+    }
+    for name, func in (("clean_title", clean_title), ("fonts", load_font), ("cover_images", load_cover_image)):
+        info = func.cache_info()
+        counters[name] = (info.hits, info.misses)
+    return counters
+
+def prometheus_metrics(record):
+    lines = []
+
+    def metric(name, help_text, samples):
+        lines.append(f"# HELP meloday_{name} {help_text}")
+        lines.append(f"# TYPE meloday_{name} gauge")
+        for labels, value in samples:
+            label_text = ",".join(f'{label}="{label_value}"' for label, label_value in labels.items())
+            lines.append(f"meloday_{name}{{{label_text}}} {value}" if label_text else f"meloday_{name} {value}")
+
+    metric("last_run_timestamp_seconds", "Start of the last run.",
+           [({}, int(datetime.fromisoformat(record["started_at"]).timestamp()))])
+    metric("run_seconds", "Wall time of the last run.", [({}, record["seconds"])])
+    metric("run_requests", "Plex requests made by the last run.", [({}, record["requests"])])
+    metric("run_bytes", "Bytes received from Plex by the last run.", [({}, record["bytes"])])
+    metric("run_retries", "Plex requests retried by the last run.", [({}, record["retries"])])
+    for field, help_text in (
+        ("seconds", "Wall time per stage in the last run."),
+        ("requests", "Plex requests per stage in the last run."),
+        ("bytes", "Bytes received from Plex per stage in the last run."),
+    ):
+        metric(f"stage_{field}", help_text,
+               [({"stage": name}, stage[field]) for name, stage in record["stages"].items()])
+    for field in ("hits", "misses"):
+        metric(f"cache_{field}", f"Cache {field} in the last run.",
+               [({"cache": name}, counts[field]) for name, counts in record["caches"].items()])
+    for field, help_text in (
+        ("connections_opened", "Connections opened to Plex since startup."),
+        ("requests", "Requests sent over the connection pool since startup."),
+        ("idle_connections", "Connections idle in the pool at the end of the last run."),
+        ("max_connections", "Size of the connection pool."),
+    ):
+        metric(f"http_pool_{field}", help_text,
+               [({"host": host}, pool[field]) for host, pool in record["http_pool"].items()])
+    return "\n".join(lines) + "\n"
+
+def write_metrics(ctx, record):
+    """
+    Append the run's metrics as one JSON line, or replace the file with the
+    Prometheus text format (for node_exporter's textfile collector).
+    """
+    if ctx.metrics_format == "none" or not ctx.metrics_path:
+        return
+    try:
+        if ctx.metrics_format == "prometheus":
+            temp_path = ctx.metrics_path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as file:
+                file.write(prometheus_metrics(record))
+            os.replace(temp_path, ctx.metrics_path)
+        else:
+            with open(ctx.metrics_path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(record) + "\n")
+    except OSError as e:
+        print(f"Error writing metrics: {e}")
+
+def print_metrics(record):
+    print(f"Run took {record['seconds']:.1f}s, {record['requests']} Plex requests "
+          f"({record['retries']} retried), {record['bytes'] / 1e6:.1f} MB")
+    for name, stage in record["stages"].items():
+        print(f"  {name:<18} {stage['seconds']:8.2f}s {stage['requests']:6d} requests {stage['bytes'] / 1e6:8.2f} MB")
+    for host, pool in record["http_pool"].items():
+        print(f"  {host}: {pool['requests']} requests over {pool['connections_opened']} connections "
+              f"({pool['idle_connections']}/{pool['max_connections']} idle)")
+
+# ---------------------------------------------------------------------
+def get_current_time_period(ctx):
     """
     Determine which daypart the current hour belongs to.
     We do NOT sort. We rely on time_periods[period]["hours"]
@@ -64,7 +373,7 @@ def get_current_time_period():
     """
     current_hour = datetime.now().hour
 
-    for period, details in time_periods.items():
+    for period, details in ctx.time_periods.items():
         period_hours = details["hours"]  # no sorting
         if current_hour in period_hours:
             return period
@@ -72,6 +381,73 @@ def get_current_time_period():
     # Fallback if not found
     return "Late Night"
 
+def get_next_update(ctx, period, now=None):
+    """
+    The start of the hour after the period's last hour, i.e. the next
+    daypart boundary.
+    """
+    now = now or datetime.now()
+    period_hours = ctx.time_periods[period]["hours"]
+    last_hour = period_hours[-1]
+    next_update_hour = (last_hour + 1) % 24
+
+    next_update = now.replace(hour=next_update_hour, minute=0, second=0, microsecond=0)
+    if next_update_hour < now.hour:
+        next_update += timedelta(days=1)
+    return next_update
+
+def load_state(ctx):
+    """
+    Load what meloday remembers between runs (e.g. the playlist ratingKey).
+    """
+    try:
+        with open(ctx.state_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def save_state(ctx, state):
+    try:
+        with open(ctx.state_path, "w", encoding="utf-8") as file:
+            json.dump(state, file, indent=2)
+    except OSError as e:
+        print(f"Error saving state: {e}")
+
+def config_hash(config):
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def history_watermark(ctx):
+    """
+    viewedAt of the newest play in the music section as a timestamp, from a
+    one-entry history request (Plex returns the newest plays first).
+    """
+    try:
+        entries = ctx.music_section.history(maxresults=1)
+    except Exception as e:
+        print(f"Error fetching the latest play: {e}")
+        return None
+    newest = entries[0].viewedAt if entries else None
+    return int(newest.timestamp()) if newest else 0
+
+def run_manifest(ctx, periods):
+    """
+    What a run's playlists depend on besides the library: the dayparts and
+    the boundary they last until, the newest play, the config and the seed.
+    The final ratingKeys are added once the playlists are made.
+    """
+    return {
+        "periods": periods,
+        "next_update": get_next_update(ctx, get_current_time_period(ctx)).isoformat(timespec="minutes"),
+        "watermark": history_watermark(ctx),
+        "config_hash": config_hash(ctx.config),
+        "seed": ctx.random_seed,
+    }
+
+def manifest_unchanged(previous, manifest):
+    if not previous or not previous.get("tracks") or manifest["watermark"] is None:
+        return False
+    return all(previous.get(name) == value for name, value in manifest.items())
+
 def load_descriptor_map(filepath="moodmap.json"):
     try:
         with open(filepath, "r", encoding="utf-8") as file:
@@ -98,168 +474,617 @@ def wrap_text(text, font, draw, max_width):
     return lines
 
 # ---------------------------------------------------------------------
+class HistoryIndex:
+    """
+    Play history fetched once per run for the widest window needed, indexed
+    by hour of day and ratingKey. The exclusion set and the daypart filter
+    are computed locally from it instead of re-querying Plex.
+    """
+    def __init__(self, entries):
+        self.entries = [entry for entry in entries if entry.viewedAt]
+        self.by_hour = defaultdict(list)
+        self.by_key = defaultdict(list)
+        for entry in self.entries:
+            self.by_hour[entry.viewedAt.hour].append(entry)
+            self.by_key[entry.ratingKey].append(entry)
+
+    @classmethod
+    def fetch(cls, ctx, days):
+        mindate = datetime.now() - timedelta(days=days)
+        return cls(ctx.music_section.history(mindate=mindate))
+
+    def entries_in_hours(self, hours, since):
+        return [
+            entry for hour in hours for entry in self.by_hour.get(hour, [])
+            if entry.viewedAt >= since
+        ]
+
+    def keys_since(self, since):
+        return {key for key, entries in self.by_key.items() if any(e.viewedAt >= since for e in entries)}
+
+HistoryEntry = namedtuple("HistoryEntry", ["ratingKey", "viewedAt", "grandparentTitle"])
+
+class HistoryStore:
+    """
+    Persistent SQLite cache of the Plex play history. Each sync only pulls
+    entries newer than the last synced viewedAt watermark and drops plays
+    older than the window, and plays are queried locally by hour of day and
+    date range.
+    """
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS plays (
+                rating_key INTEGER NOT NULL,
+                viewed_at INTEGER NOT NULL,
+                hour INTEGER NOT NULL,
+                grandparent_title TEXT,
+                PRIMARY KEY (rating_key, viewed_at)
+            );
+            CREATE INDEX IF NOT EXISTS plays_hour_viewed_at ON plays (hour, viewed_at);
+            CREATE INDEX IF NOT EXISTS plays_viewed_at ON plays (viewed_at);
+            CREATE TABLE IF NOT EXISTS meta (
+                name TEXT PRIMARY KEY,
+                value INTEGER
+            );
+        """)
+
+    def _get_meta(self, name):
+        row = self.conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, name, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value))
+
+    def sync(self, ctx, days):
+        """
+        Pull new history from Plex and prune plays older than the window.
+        The full window is only downloaded on the first run or when the
+        lookback window grows past what is stored.
+        """
+        start = int((datetime.now() - timedelta(days=days)).timestamp())
+        synced_from = self._get_meta("synced_from")
+        watermark = self._get_meta("watermark")
+        if synced_from is None or watermark is None or start < synced_from:
+            mindate = datetime.fromtimestamp(start)
+        else:
+            mindate = datetime.fromtimestamp(watermark)
+
+        rows = [
+            (entry.ratingKey, int(entry.viewedAt.timestamp()), entry.viewedAt.hour, entry.grandparentTitle)
+            for entry in ctx.music_section.history(mindate=mindate)
+            if entry.viewedAt and entry.ratingKey
+        ]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO plays (rating_key, viewed_at, hour, grandparent_title) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self.conn.execute("DELETE FROM plays WHERE viewed_at < ?", (start,))
+            newest = max([row[1] for row in rows] + [watermark or 0])
+            self._set_meta("watermark", newest)
+            self._set_meta("synced_from", start)
+        return len(rows)
+
+    def entries_in_hours(self, hours, since):
+        hours = list(hours)
+        placeholders = ", ".join("?" for _ in hours)
+        rows = self.conn.execute(
+            f"SELECT rating_key, viewed_at, grandparent_title FROM plays "
+            f"WHERE hour IN ({placeholders}) AND viewed_at >= ? ORDER BY viewed_at DESC",
+            hours + [int(since.timestamp())]
+        )
+        return [HistoryEntry(key, datetime.fromtimestamp(viewed_at), artist) for key, viewed_at, artist in rows]
+
+    def keys_since(self, since):
+        rows = self.conn.execute(
+            "SELECT DISTINCT rating_key FROM plays WHERE viewed_at >= ?", (int(since.timestamp()),)
+        )
+        return {row[0] for row in rows}
+
+def fetch_play_history(ctx):
+    """
+    Fetch the play history once, covering both the lookback and exclude windows.
+    Uses the local history store when one is configured.
+    """
+    days = max(ctx.history_lookback_days, ctx.exclude_played_days)
+    if not ctx.history_db_path:
+        return HistoryIndex.fetch(ctx, days)
+    ctx.history_store.sync(ctx, days)
+    return ctx.history_store
+
+def tag_names(track, field):
+    """
+    Tag names of a plexapi object's genres or moods. plexapi parses tags
+    lazily from the response on first read, and reading them the usual way
+    reloads the object when the list is empty (multi-key responses count
+    as partial); object.__getattribute__ parses them without that reload.
+    """
+    try:
+        tags = object.__getattribute__(track, field)
+    except AttributeError:
+        return ()
+    return tuple(tag.tag for tag in tags or ())
+
+class TrackRecord:
+    """
+    The fields of a Plex track that meloday uses, copied once where the
+    track is fetched. Unlike plexapi objects, reading a field never reloads
+    from the server, and records hash and compare by ratingKey. genres and
+    moods are tuples of tag names, or None while not loaded (see load_tags).
+    """
+    __slots__ = (
+        "ratingKey", "parentRatingKey", "grandparentRatingKey", "title", "grandparentTitle",
+        "genres", "moods", "lastViewedAt", "userRating", "_server",
+    )
+    listType = "audio"  # with ratingKey and _server, all plexapi needs to put a record in a playlist
+
+    def __init__(self, ratingKey, parentRatingKey=None, grandparentRatingKey=None, title=None,
+                 grandparentTitle=None, genres=None, moods=None, lastViewedAt=None, userRating=None,
+                 server=None):
+        self.ratingKey = ratingKey
+        self.parentRatingKey = parentRatingKey
+        self.grandparentRatingKey = grandparentRatingKey
+        self.title = title
+        self.grandparentTitle = grandparentTitle
+        self.genres = genres
+        self.moods = moods
+        self.lastViewedAt = lastViewedAt
+        self.userRating = userRating
+        self._server = server
+
+    @classmethod
+    def from_plex(cls, track, tags=True):
+        """
+        Copy a plexapi Track. Only values already in the object are read, so
+        a partial object is not reloaded; with tags=False (partial responses,
+        which carry no tags) genres and moods are left unloaded.
+        """
+        data = vars(track)
+        return cls(
+            data.get("ratingKey"), data.get("parentRatingKey"), data.get("grandparentRatingKey"),
+            data.get("title"), data.get("grandparentTitle"),
+            tag_names(track, "genres") if tags else None,
+            tag_names(track, "moods") if tags else None,
+            data.get("lastViewedAt"), data.get("userRating"), data.get("_server"),
+        )
+
+    def __eq__(self, other):
+        if isinstance(other, TrackRecord):
+            return self.ratingKey == other.ratingKey
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.ratingKey)
+
+    def __repr__(self):
+        return f"<TrackRecord:{self.ratingKey}:{self.title}>"
+
+def fetch_items_by_key(ctx, keys, batch_size=100, failed=None):
+    """
+    Fetch Plex items for the given ratingKeys with multi-key requests.
+    Returns {ratingKey: item}; keys Plex no longer knows are left out.
+    A batch that fails is retried once. If it fails again the error is
+    printed and its keys are added to failed, when given, so callers can
+    tell keys that could not be fetched from keys Plex does not know.
+    """
+    keys = sorted(set(keys))
+    items = {}
+    for i in range(0, len(keys), batch_size):
+        chunk = keys[i:i + batch_size]
+        for attempt in range(2):
+            ctx.request_limiter.wait()
+            try:
+                fetched = ctx.plex.fetchItems([int(key) for key in chunk])
+                break
+            except Exception as e:
+                error = e
+        else:
+            print(f"Error fetching {len(chunk)} items: {error}")
+            if failed is not None:
+                failed.update(chunk)
+            continue
+        for item in fetched:
+            items[item.ratingKey] = item
+    return items
+
+def fetch_tracks_by_key(ctx, keys, batch_size=100):
+    """
+    fetch_items_by_key for tracks, returning {ratingKey: TrackRecord}.
+    Multi-key responses carry the full metadata, tags included. Records
+    are kept in ctx.track_records for the rest of the run, so a track is
+    fetched once however many periods and stages need it.
+    """
+    keys = set(keys)
+    missing = keys - ctx.track_records.keys()
+    if missing:
+        for key, item in fetch_items_by_key(ctx, missing, batch_size).items():
+            ctx.track_records[key] = TrackRecord.from_plex(item)
+    return {key: ctx.track_records[key] for key in keys if key in ctx.track_records}
+
+LOW_RATINGS = "1,2"  # userRating values of a half and a whole star, i.e. a rating <= 2
+
+def search_tracks_by_key(ctx, keys, batch_size=100):
+    """
+    fetch_tracks_by_key for candidate_source "server": a music section
+    search over the ratingKeys with meloday's exclusions as Plex filters,
+    so tracks that are low rated, on a low-rated album or by a low-rated
+    artist, or played within exclude_played_days are never transferred.
+    Search results carry no tags. The albums and artists of the tracks
+    returned are recorded as not low rated, so they are never fetched.
+    Each key's outcome is kept in ctx.searched_tracks for the rest of the
+    run (None for a track the search left out); keys of a failed search
+    are not, so they are searched again.
+    """
+    exclude_start = datetime.now() - timedelta(days=ctx.exclude_played_days)
+    section_key = ctx.music_section.key
+    keys = set(keys)
+    missing = sorted(keys - ctx.searched_tracks.keys())
+    for i in range(0, len(missing), batch_size):
+        chunk = missing[i:i + batch_size]
+        params = [
+            ("type", 10),
+            ("id", ",".join(str(key) for key in chunk)),
+            ("userRating!", LOW_RATINGS),
+            ("album.userRating!", LOW_RATINGS),
+            ("artist.userRating!", LOW_RATINGS),
+            # Never played, or last played before the exclude window
+            ("push", 1), ("viewCount", 0), ("or", 1), ("lastViewedAt<<", int(exclude_start.timestamp())), ("pop", 1),
+        ]
+        ctx.request_limiter.wait()
+        try:
+            found = {
+                item.ratingKey: TrackRecord.from_plex(item, tags=False)
+                for item in ctx.plex.fetchItems(f"/library/sections/{section_key}/all?{urlencode(params)}")
+            }
+        except Exception as e:
+            print(f"Error searching tracks: {e}")
+            continue
+        for key in chunk:
+            ctx.searched_tracks[key] = found.get(key)
+    tracks = {key: ctx.searched_tracks[key] for key in keys if ctx.searched_tracks.get(key) is not None}
+    ctx.rating_resolver.mark_not_low_rated(tracks.values())
+    return tracks
+
+def fetch_candidate_tracks(ctx, keys, batch_size=100):
+    """
+    Fetch candidate tracks by ratingKey as {ratingKey: TrackRecord}. With
+    candidate_source "server" Plex leaves out excluded tracks; otherwise
+    every track is fetched and the exclusions are applied here.
+    """
+    if ctx.candidate_source == "server":
+        return search_tracks_by_key(ctx, keys, batch_size)
+    return fetch_tracks_by_key(ctx, keys, batch_size)
+
+def load_tags(ctx, tracks, batch_size=100):
+    """
+    Load the genres and moods of records that came from partial responses,
+    with multi-key requests for their full metadata.
+    """
+    missing = [track for track in tracks if track.genres is None]
+    if not missing:
+        return
+    loaded = fetch_tracks_by_key(ctx, (track.ratingKey for track in missing), batch_size)
+    for track in missing:
+        record = loaded.get(track.ratingKey)
+        track.genres = record.genres if record else ()
+        track.moods = record.moods if record else ()
+
 # Removed most debugging prints from these functions,
 # except for warnings or errors.
-def fetch_historical_tracks(period):
+def fetch_historical_tracks(ctx, period, history=None):
     """
     Fetch tracks from Plex history that match the current daypart,
     while excluding recently played tracks.
     """
-    music_section = plex.library.section(MUSIC_LIBRARY)
+    if history is None:
+        history = fetch_play_history(ctx)
     now = datetime.now()
-    period_hours = set(time_periods[period]["hours"])
+    period_hours = ctx.time_periods[period]["hours"]
 
-    history_start = now - timedelta(days=HISTORY_LOOKBACK_DAYS)
-    exclude_start = now - timedelta(days=EXCLUDE_PLAYED_DAYS)
+    history_start = now - timedelta(days=ctx.history_lookback_days)
+    exclude_start = now - timedelta(days=ctx.exclude_played_days)
 
-    history_entries = [
-        entry for entry in music_section.history(mindate=history_start)
-        if entry.viewedAt and entry.viewedAt.hour in period_hours
-    ]
-    excluded_entries = [
-        entry for entry in music_section.history(mindate=exclude_start)
-        if entry.viewedAt
-    ]
-
-    excluded_keys = {entry.ratingKey for entry in excluded_entries}
+    history_entries = history.entries_in_hours(period_hours, history_start)
+    excluded_keys = history.keys_since(exclude_start)
     filtered_tracks = [
         entry for entry in history_entries
         if entry.ratingKey not in excluded_keys
     ]
 
-    # If no historical tracks found, fallback
-    if not filtered_tracks:
-        fallback_entries = [
-            entry for entry in music_section.history(mindate=history_start)
-            if entry.viewedAt and entry.viewedAt.hour in period_hours
-               and entry.ratingKey not in excluded_keys
-        ]
-        if fallback_entries:
-            filtered_tracks = fallback_entries
-
     # Genre balancing
     track_play_counts = Counter()
     genre_count = Counter()
     for track in filtered_tracks:
-        track_play_counts[track] += 1
+        track_play_counts[track.ratingKey] += 1
         for genre in track.grandparentTitle or []:
             genre_count[genre] += 1
 
-    sorted_tracks = sorted(filtered_tracks, key=lambda t: track_play_counts[t], reverse=True)
+    sorted_tracks = sorted(filtered_tracks, key=lambda t: track_play_counts[t.ratingKey], reverse=True)
     split_index = max(1, len(sorted_tracks) // 4)
     popular_tracks = sorted_tracks[:split_index]
     rare_tracks = sorted_tracks[split_index:]
 
     balanced_selection = (
-        random.sample(rare_tracks, min(len(rare_tracks), int(MAX_TRACKS * 0.75)))
-        + random.sample(popular_tracks, min(len(popular_tracks), int(MAX_TRACKS * 0.25)))
+        random.sample(rare_tracks, min(len(rare_tracks), int(ctx.max_tracks * 0.75)))
+        + random.sample(popular_tracks, min(len(popular_tracks), int(ctx.max_tracks * 0.25)))
     )
 
+    # History entries only carry keys; load the selected tracks in bulk
+    tracks_by_key = fetch_candidate_tracks(ctx, (t.ratingKey for t in balanced_selection))
+    balanced_selection = [tracks_by_key[t.ratingKey] for t in balanced_selection if t.ratingKey in tracks_by_key]
+
     if genre_count:
         most_common_genre, most_common_count = genre_count.most_common(1)[0]
-        max_genre_limit = int(MAX_TRACKS * 0.25)
+        max_genre_limit = int(ctx.max_tracks * 0.25)
         if most_common_count > max_genre_limit:
+            # Server-side search results carry no tags (genres is None)
             balanced_selection = (
-                [t for t in balanced_selection if most_common_genre not in t.genres][:max_genre_limit]
-                + [t for t in balanced_selection if most_common_genre in t.genres][:max_genre_limit]
+                [t for t in balanced_selection if most_common_genre not in (t.genres or ())][:max_genre_limit]
+                + [t for t in balanced_selection if most_common_genre in (t.genres or ())][:max_genre_limit]
             )
 
     return balanced_selection, excluded_keys
 
-def filter_low_rated_tracks(tracks):
+class RatingResolver:
+    """
+    Resolve album and artist ratings in bulk. The unique parent ratingKeys
+    of a batch are fetched with multi-key requests and kept for the rest of
+    the run, so no album or artist is ever fetched twice.
+
+    Only ratings that were actually fetched are cached. Keys whose requests
+    failed (after fetch_items_by_key's retry) are unresolved: they are not
+    requested again until the next evict_older_than, and is_low_rated drops
+    their tracks rather than letting them through unchecked.
+    """
+    def __init__(self, ctx, batch_size=100):
+        self.ctx = ctx
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+        self._ratings = {}
+        self._fetched_at = {}
+        self._unresolved = set()
+
+    def prefetch(self, tracks):
+        missing = set()
+        for track in tracks:
+            for key in (getattr(track, "parentRatingKey", None), getattr(track, "grandparentRatingKey", None)):
+                if not key or key in self._unresolved:
+                    continue
+                if key in self._ratings:
+                    self.hits += 1
+                else:
+                    missing.add(key)
+
+        self.misses += len(missing)
+        if missing:
+            failed = set()
+            items = fetch_items_by_key(self.ctx, missing, self.batch_size, failed)
+            self._unresolved |= failed
+            fetched_at = time.monotonic()
+            for key in missing - failed:
+                item = items.get(key)
+                self._ratings[key] = getattr(item, "userRating", None) if item else None
+                self._fetched_at[key] = fetched_at
+
+    def rating(self, key):
+        return self._ratings.get(key)
+
+    def mark_not_low_rated(self, tracks):
+        """
+        Record the albums and artists of tracks that a server-side search
+        found not low rated, without fetching them.
+        """
+        fetched_at = time.monotonic()
+        for track in tracks:
+            for key in (track.parentRatingKey, track.grandparentRatingKey):
+                if key and key not in self._ratings:
+                    self._ratings[key] = None
+                    self._fetched_at[key] = fetched_at
+                    self._unresolved.discard(key)
+
+    def has_ratings(self, track):
+        """
+        True if prefetch has nothing left to do for the track: its album and
+        artist ratings are cached or could not be fetched.
+        """
+        return all(
+            not key or key in self._ratings or key in self._unresolved
+            for key in (getattr(track, "parentRatingKey", None), getattr(track, "grandparentRatingKey", None))
+        )
+
+    def is_unresolved(self, track):
+        return any(
+            key in self._unresolved
+            for key in (getattr(track, "parentRatingKey", None), getattr(track, "grandparentRatingKey", None))
+        )
+
+    def evict_older_than(self, cutoff):
+        for key in [key for key, fetched_at in self._fetched_at.items() if fetched_at < cutoff]:
+            del self._ratings[key]
+            del self._fetched_at[key]
+        # Keys that could not be fetched are tried again on the next cycle
+        self._unresolved.clear()
+
+def filter_low_rated_tracks(ctx, tracks):
     """
     Filter out tracks, albums, or artists with a 1-star rating (rating <=2),
     skipping ephemeral tracks that lack ratingKey or parentRatingKey.
+    Album and artist ratings are resolved in bulk through ctx.rating_resolver.
     """
+    resolver = ctx.rating_resolver
+    tracks = [
+        track for track in tracks
+        if getattr(track, "ratingKey", None) and getattr(track, "parentRatingKey", None)
+    ]
+    resolver.prefetch(tracks)
+
     filtered = []
     for track in tracks:
         try:
-            if not getattr(track, "ratingKey", None) or not getattr(track, "parentRatingKey", None):
-                continue
-            artist = track.artist() if callable(getattr(track, "artist", None)) else None
-            artist_rating = getattr(artist, "userRating", None) if artist else None
-            album = plex.fetchItem(track.parentRatingKey)
-            album_rating = getattr(album, "userRating", None) if album else None
-            track_rating = getattr(track, "userRating", None)
-
-            if artist_rating is not None and artist_rating <= 2:
-                continue
-            if album_rating is not None and album_rating <= 2:
-                continue
-            if track_rating is not None and track_rating <= 2:
-                continue
-
-            filtered.append(track)
+            if not is_low_rated(resolver, track):
+                filtered.append(track)
         except Exception:
             # Just skip if something goes wrong
             pass
     return filtered
 
-def clean_title(title):
-    version_keywords = [
-        "extended", "deluxe", "remaster", "remastered", "live", "acoustic", "edit",
-        "version", "anniversary", "special edition", "radio edit", "album version",
-        "original mix", "remix", "mix", "dub", "instrumental", "karaoke", "cover",
-        "rework", "re-edit", "bootleg", "vip", "session", "alternate", "take",
-        "mix cut", "cut", "dj mix"
-    ]
-
-    featuring_patterns = [
+def is_low_rated(resolver, track):
+    """
+    True if the track, its album or its artist has a 1-star rating (<= 2).
+    The album and artist ratings must already be prefetched; a track whose
+    album or artist rating could not be fetched counts as low rated, so it
+    is dropped instead of passing unchecked.
+    """
+    if resolver.is_unresolved(track):
+        return True
+    artist_rating = resolver.rating(getattr(track, "grandparentRatingKey", None))
+    album_rating = resolver.rating(track.parentRatingKey)
+    track_rating = getattr(track, "userRating", None)
+
+    if artist_rating is not None and artist_rating <= 2:
+        return True
+    if album_rating is not None and album_rating <= 2:
+        return True
+    if track_rating is not None and track_rating <= 2:
+        return True
+    return False
+
+# Same keywords, in the same order, as the original one-re.sub-per-keyword loop.
+# Multi-word keywords containing an earlier keyword ("radio edit", "mix cut", ...)
+# could never match once that keyword was stripped, so they are left out.
+VERSION_KEYWORDS = [
+    "extended", "deluxe", "remaster", "remastered", "live", "acoustic", "edit",
+    "version", "anniversary", "special edition", "original mix", "remix", "mix",
+    "dub", "instrumental", "karaoke", "cover", "rework", "bootleg", "vip",
+    "session", "alternate", "take", "cut"
+]
+VERSION_KEYWORDS_RE = re.compile(
+    r"\b(?:" + "|".join(re.escape(keyword) for keyword in VERSION_KEYWORDS) + r")\b",
+    re.IGNORECASE
+)
+FEATURING_RES = [
+    re.compile(pattern, re.IGNORECASE) for pattern in (
         r"\(feat\.?.*?\)", r"\[feat\.?.*?\]", r"\(ft\.?.*?\)", r"\[ft\.?.*?\]",
         r"\bfeat\.?\s+\w+", r"\bfeaturing\s+\w+", r"\bft\.?\s+\w+",
         r" - .*mix$", r" - .*dub$", r" - .*remix$", r" - .*edit$", r" - .*version$"
-    ]
+    )
+]
+TRAILING_RE = re.compile(r"[\s-]+$")
 
+@lru_cache(maxsize=65536)
+def clean_title(title):
     title_clean = title.lower().strip()
 
-    for pattern in featuring_patterns:
-        title_clean = re.sub(pattern, '', title_clean, flags=re.IGNORECASE).strip()
-
-    for keyword in version_keywords:
-        title_clean = re.sub(rf"\b{keyword}\b", "", title_clean, flags=re.IGNORECASE).strip()
+    for pattern in FEATURING_RES:
+        title_clean = pattern.sub("", title_clean).strip()
 
-    title_clean = re.sub(r"[\s-]+$", "", title_clean)  # Trim trailing spaces or hyphens
+    title_clean = VERSION_KEYWORDS_RE.sub("", title_clean).strip()
+    title_clean = TRAILING_RE.sub("", title_clean)  # Trim trailing spaces or hyphens
     return title_clean
 
 
-def process_tracks(tracks):
+RATING_LOOKAHEAD = 50  # candidates whose tags or album/artist ratings are fetched together
+
+def candidate_tracks(tracks, excluded_keys=None):
+    """
+    First, free stage of process_tracks: drop ephemeral tracks without a
+    ratingKey or album and tracks in the exclusion set. Only attributes
+    every Plex response carries are read, so partial objects never reload.
+    """
+    for track in tracks:
+        if not getattr(track, "ratingKey", None) or not getattr(track, "parentRatingKey", None):
+            continue
+        if not hasattr(track, "title"):
+            continue
+        if excluded_keys and track.ratingKey in excluded_keys:
+            continue
+        yield track
+
+def dedup_key(track):
+    # grandparentTitle is the artist's title, without fetching the artist
+    artist_name = track.grandparentTitle.lower().strip() if track.grandparentTitle is not None else "unknown"
+    return clean_title(track.title), artist_name
+
+def process_tracks(ctx, tracks, limit=None, excluded_keys=None):
     """
     Process tracks to remove duplicates and balance artist/genre representation.
+
+    Candidates stream through the cheap checks first (exclusions, title +
+    artist dedup, artist cap), then the genre cap and the rating checks.
+    Tags that are not loaded yet and album and artist ratings are fetched
+    in batches for the candidates that can still be accepted, and
+    evaluation stops once limit tracks are accepted. The result is the same
+    as rating-filtering everything up front, truncated to limit.
     """
-    filtered_tracks = filter_low_rated_tracks(tracks)
+    resolver = ctx.rating_resolver
     seen_titles = set()
+    # Titles dropped by the genre cap before their rating was known: they
+    # only count as seen if one of those tracks turns out not to be low-rated
+    unrated_titles = defaultdict(list)
     unique_tracks = []
     artist_count = Counter()
     genre_count = Counter()
-    artist_limit = round(MAX_TRACKS * 0.05)
+    artist_limit = round(ctx.max_tracks * 0.05)
+    genre_limit = int(ctx.max_tracks * 0.15)
 
-    for track in filtered_tracks:
-        try:
-            if not hasattr(track, "ratingKey") or not hasattr(track, "title") or not hasattr(track, "artist"):
-                continue
+    candidates = candidate_tracks(tracks, excluded_keys)
+    lookahead = deque()
 
+    def could_accept(track):
+        # Seen titles and artist counts only grow, so this stays False once False
+        title_key = dedup_key(track)
+        return title_key not in seen_titles and artist_count[title_key[1]] < artist_limit
+
+    def upcoming_batch(track):
+        while len(lookahead) < RATING_LOOKAHEAD:
+            upcoming = next(candidates, None)
+            if upcoming is None:
+                break
+            lookahead.append(upcoming)
+        return [track] + [t for t in lookahead if could_accept(t)]
+
+    def passes_ratings(track):
+        if not resolver.has_ratings(track):
+            resolver.prefetch(upcoming_batch(track))
+        return not is_low_rated(resolver, track)
+
+    while limit is None or len(unique_tracks) < limit:
+        track = lookahead.popleft() if lookahead else next(candidates, None)
+        if track is None:
+            break
+        try:
             # Normalize title & artist for comparison
-            title_clean = clean_title(track.title)
-            artist_obj = track.artist() if callable(getattr(track, "artist", None)) else track.artist
-            artist_name = artist_obj.title.lower().strip() if artist_obj else "unknown"
-            track_key = (title_clean, artist_name)
+            title_key = dedup_key(track)
+            artist_name = title_key[1]
 
             # Deduplicate strictly by title + artist (ignoring ratingKey)
-            if track_key in seen_titles:
+            if title_key in seen_titles:
                 continue
 
-            seen_titles.add(track_key)
-
             # Ensure artist balance
             if artist_count[artist_name] >= artist_limit:
                 continue
 
             # Ensure genre balance
+            if track.genres is None:
+                load_tags(ctx, upcoming_batch(track))
             track_genre = track.genres[0] if track.genres else "Unknown"
-            if genre_count[track_genre] >= int(MAX_TRACKS * 0.15):
+            if genre_count[track_genre] >= genre_limit:
+                unrated_titles[title_key].append(track)
+                continue
+
+            if title_key in unrated_titles:
+                if any(passes_ratings(t) for t in unrated_titles.pop(title_key)):
+                    seen_titles.add(title_key)
+                    continue
+
+            if not passes_ratings(track):
                 continue
 
             # Store track as unique
+            seen_titles.add(title_key)
             artist_count[artist_name] += 1
             genre_count[track_genre] += 1
             unique_tracks.append(track)
@@ -272,18 +1097,239 @@ def process_tracks(tracks):
 
 
 
-def fetch_sonically_similar_tracks(reference_tracks, excluded_keys=None):
+class RateLimiter:
+    """
+    Thread-safe cap on the number of requests per second sent to the Plex
+    server. A rate of 0 disables the cap. Every bulk request goes through
+    ctx.request_limiter: sonically-similar and /nearest lookups, index
+    builds, multi-key fetches and server-side candidate searches.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+# ---------------------------------------------------------------------
+# Offline sonic-neighbor index
+PLEX_DEFAULT_MAX_DISTANCE = 0.25  # what /nearest uses when maxDistance is not given
+SONIC_INDEX_PAGE_SIZE = 500
+
+def sonic_index_dtype(neighbors):
+    import numpy as np
+    return np.dtype([
+        ("key", np.int64),
+        ("stamp", np.int64),
+        ("neighbors", np.int64, (neighbors,)),
+        ("distances", np.float32, (neighbors,)),
+    ])
+
+class SonicIndex:
+    """
+    Memory-mapped sonic-neighbor index written by `meloday.py --build-index`:
+    one record per track, sorted by ratingKey, with its nearest neighbors
+    and their distances. The file is opened on the first lookup and only
+    the pages that are touched are read. Without a file every lookup
+    returns None and callers ask Plex instead.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._records = None
+        self._keys = None
+        self._mtime = None
+        self._opened = False
+
+    def records(self):
+        if not self._opened:
+            self._opened = True
+            if self.path and os.path.exists(self.path):
+                import numpy as np
+                try:
+                    self._mtime = os.stat(self.path).st_mtime_ns
+                    self._records = np.load(self.path, mmap_mode="r")
+                    # A contiguous copy of the keys, so searchsorted does not copy them per lookup
+                    self._keys = np.ascontiguousarray(self._records["key"])
+                except (OSError, ValueError) as e:
+                    print(f"Error opening sonic index: {e}")
+                    self._records = None
+        return self._records
+
+    def close(self):
+        self._records = None
+        self._keys = None
+        self._opened = False
+
+    def reopen_if_changed(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns if self.path else None
+        except OSError:
+            mtime = None
+        if mtime != self._mtime:
+            self.close()
+
+    def lookup(self, key, limit=None, max_distance=None):
+        """
+        Return [(ratingKey, distance)] nearest first, or None when the track
+        is not in the index.
+        """
+        records = self.records()
+        if records is None:
+            return None
+        import numpy as np
+        i = int(np.searchsorted(self._keys, key))
+        if i == len(self._keys) or self._keys[i] != key:
+            self.misses += 1
+            return None
+        self.hits += 1
+        record = records[i]
+        neighbors = [
+            (int(neighbor), float(distance))
+            for neighbor, distance in zip(record["neighbors"], record["distances"])
+            if neighbor and (max_distance is None or distance <= max_distance)
+        ]
+        return neighbors[:limit] if limit else neighbors
+
+    def save(self, records):
+        temp_path = self.path + ".tmp"
+        import numpy as np
+        with open(temp_path, "wb") as file:
+            np.save(file, records)
+        # The old file may still be mapped (Windows refuses to replace it then)
+        self.close()
+        os.replace(temp_path, self.path)
+
+def track_stamp(track):
+    stamps = [stamp for stamp in (getattr(track, "addedAt", None), getattr(track, "updatedAt", None)) if stamp]
+    return int(max(stamps).timestamp()) if stamps else 0
+
+def build_sonic_index(ctx, full=False):
+    """
+    Walk the music section and store every track's sonic neighbors in the
+    index file. Unless full, only tracks added or updated after the newest
+    track already in the index are fetched; the rest are kept as they are.
+    """
+    import numpy as np
+    index = ctx.sonic_index
+    if not index.path:
+        print("No sonic index path configured (sonic_index.path).")
+        return
+
+    dtype = sonic_index_dtype(ctx.sonic_index_neighbors)
+    existing = None if full else index.records()
+    if existing is not None and existing.dtype != dtype:
+        print("The sonic index was built with a different neighbor count, rebuilding it.")
+        existing = None
+
+    filters = None
+    if existing is not None and len(existing):
+        since = datetime.fromtimestamp(int(existing["stamp"].max()))
+        filters = {"or": [{"addedAt>>": since}, {"updatedAt>>": since}]}
+        print(f"Indexing tracks added or updated since {since:%Y-%m-%d %H:%M}...")
+    else:
+        print("Indexing the whole music library...")
+
+    def index_track(track):
+        ctx.request_limiter.wait()
+        try:
+            similars = track.sonicallySimilar(
+                limit=ctx.sonic_index_neighbors, maxDistance=ctx.sonic_index_max_distance
+            )
+        except Exception as e:
+            print(f"Error fetching sonically similar tracks for {track.title}: {e}")
+            return None
+        record = np.zeros(1, dtype)[0]
+        record["key"] = track.ratingKey
+        record["stamp"] = track_stamp(track)
+        record["distances"] = np.inf
+        for i, similar in enumerate(similars[:ctx.sonic_index_neighbors]):
+            record["neighbors"][i] = similar.ratingKey
+            distance = getattr(similar, "distance", None)
+            record["distances"][i] = distance if distance is not None else 0.0
+        return record
+
+    pages = []
+    start = 0
+    with ThreadPoolExecutor(max_workers=max(1, ctx.fetch_workers)) as executor:
+        while True:
+            page = ctx.music_section.searchTracks(
+                filters=filters, container_start=start,
+                container_size=SONIC_INDEX_PAGE_SIZE, maxresults=SONIC_INDEX_PAGE_SIZE
+            )
+            records = [record for record in executor.map(index_track, page) if record is not None]
+            if records:
+                pages.append(np.array(records, dtype))
+            start += len(page)
+            if page:
+                print(f"Indexed {start} tracks...")
+            if len(page) < SONIC_INDEX_PAGE_SIZE:
+                break
+
+    fresh = np.concatenate(pages) if pages else np.zeros(0, dtype)
+    if existing is not None:
+        existing = existing[~np.isin(existing["key"], fresh["key"])]
+        fresh = np.concatenate([existing, fresh])
+        del existing
+    fresh = fresh[np.argsort(fresh["key"], kind="stable")]
+    fresh = fresh[np.concatenate([fresh["key"][1:] != fresh["key"][:-1], [True]])] if len(fresh) else fresh
+    index.save(fresh)
+    print(f"Sonic index has {len(fresh)} tracks ({os.path.getsize(index.path) / 1e6:.1f} MB).")
+
+# ---------------------------------------------------------------------
+def fetch_nearest(ctx, key, limit=None, max_distance=None):
+    """
+    The request behind Track.sonicallySimilar, by ratingKey, returning
+    [(ratingKey, distance)] nearest first, like SonicIndex.lookup. Plex's
+    default maxDistance applies when none is given.
+    """
+    params = {}
+    if limit is not None:
+        params["limit"] = limit
+    if max_distance is not None:
+        params["maxDistance"] = max_distance
+    path = f"/library/metadata/{key}/nearest"
+    if params:
+        path += "?" + urlencode(params)
+    # vars: a missing distance must not make plexapi reload the item
+    return [(item.ratingKey, vars(item).get("distance")) for item in ctx.plex.fetchItems(path)]
+
+def fetch_sonically_similar_tracks(ctx, reference_tracks, excluded_keys=None, workers=None):
     """
     Fetch sonically similar tracks while ensuring excluded tracks (played in the last X days) are removed.
+    Neighbor lists come from ctx.sonic_graph, so they are shared with sequencing,
+    the frontier and the other dayparts of the run; with more than one worker the
+    missing ones are requested in parallel. The neighbors of all reference tracks
+    are then loaded with multi-key requests and filtered in reference order so
+    seeded runs stay reproducible.
     """
     similar_tracks = []
     now = datetime.now()
-    exclude_start = now - timedelta(days=EXCLUDE_PLAYED_DAYS)
+    exclude_start = now - timedelta(days=ctx.exclude_played_days)
+    workers = workers or ctx.fetch_workers
 
-    for track in reference_tracks:
-        try:
-            similars = track.sonicallySimilar(limit=SONIC_SIMILAR_LIMIT)
+    graph = ctx.sonic_graph
+    graph.prefetch(reference_tracks, workers, ctx.sonic_similar_limit, PLEX_DEFAULT_MAX_DISTANCE)
+    neighbor_keys = [
+        graph.neighbor_keys(track, ctx.sonic_similar_limit, PLEX_DEFAULT_MAX_DISTANCE) for track in reference_tracks
+    ]
+    wanted = {key for keys in neighbor_keys for key in keys if not (excluded_keys and key in excluded_keys)}
+    # With candidate_source "server", Plex already leaves out excluded tracks here
+    items = fetch_candidate_tracks(ctx, wanted) if wanted else {}
 
+    filtered = []
+    for keys in neighbor_keys:
+        similars = [items[key] for key in keys if key in items]
+        try:
             # Ensure we're filtering by last play date
             filtered_similars = []
             for s in similars:
@@ -300,54 +1346,278 @@ def fetch_sonically_similar_tracks(reference_tracks, excluded_keys=None):
                     continue
 
                 filtered_similars.append(s)
-
-            # Run deduplication **before** adding similar tracks
-            final_similars = process_tracks(filter_low_rated_tracks(filtered_similars))
-            similar_tracks.extend(final_similars)
+            filtered.append(filtered_similars)
 
         except Exception as e:
-            print(f"Error fetching sonically similar tracks: {e}")
+            print(f"Error processing sonically similar tracks: {e}")
             pass
 
+    # Server-side search results carry no genres or moods; load them for all
+    # reference tracks at once, before the genre cap in process_tracks
+    load_tags(ctx, [s for filtered_similars in filtered for s in filtered_similars])
+
+    for filtered_similars in filtered:
+        # Run deduplication **before** adding similar tracks
+        # (process_tracks already drops low-rated tracks)
+        similar_tracks.extend(process_tracks(ctx, filtered_similars))
+
     return similar_tracks
 
 
 
 
-def similarity_score(current, candidate, limit=20, max_distance=1.0):
-    try:
-        similars = current.sonicallySimilar(limit=limit, maxDistance=max_distance)
-    except Exception:
-        return 100
-    for index, track in enumerate(similars):
-        if track.ratingKey == candidate.ratingKey:
-            return index
-    return 100
-
-def sort_by_sonic_similarity_greedy(tracks, limit=20, max_distance=1.0):
-    if len(tracks) < 2:
-        return tracks
-    remaining = list(tracks)
-    sorted_list = []
-    start_index = random.randrange(len(remaining))
-    current = remaining.pop(start_index)
-    sorted_list.append(current)
+class SonicNeighborGraph:
+    """
+    Memoized sonic-neighbor graph. Each track's neighbor list is read from
+    the sonic index or, for tracks not in it, fetched from Plex at most
+    once, and kept by ratingKey so rank lookups while sorting are O(1).
+    Lists are fetched with the widest limit and max_distance any caller
+    asked for (at least the graph's own) and cut down for each caller, so
+    candidate gathering, sequencing and expansion share one request per
+    track. request_count tracks how many sonicallySimilar requests were
+    actually issued. fetch(ratingKey, limit, max_distance) returns a
+    track's [(ratingKey, distance)]; without it the tracks' own
+    sonicallySimilar is used.
+    """
+    def __init__(self, limit=20, max_distance=1.0, index=None, limiter=None, fetch=None):
+        self.limit = limit
+        self.max_distance = max_distance
+        self.index = index
+        self.limiter = limiter
+        self.fetch = fetch
+        self.request_count = 0
+        self.hits = 0
+        self.misses = 0
+        self._lists = {}
+        self._ranks = {}
+        self._fetched_at = {}
+        self._lock = threading.Lock()
+
+    def _covers(self, key, limit, max_distance):
+        cached = self._lists.get(key)
+        return cached is not None and cached[0] >= limit and cached[1] >= max_distance
+
+    def neighbor_keys(self, track, limit=None, max_distance=None):
+        """
+        Return the ratingKeys of the track's nearest neighbors, nearest
+        first, within limit and max_distance (the graph's own by default).
+        """
+        limit = self.limit if limit is None else limit
+        max_distance = self.max_distance if max_distance is None else max_distance
+        indexed = self.index.lookup(track.ratingKey, limit, max_distance) if self.index else None
+        if indexed is not None:
+            return [key for key, _ in indexed]
+
+        if self._covers(track.ratingKey, limit, max_distance):
+            with self._lock:
+                self.hits += 1
+        else:
+            with self._lock:
+                self.misses += 1
+                self.request_count += 1
+            fetch_limit, fetch_distance = max(limit, self.limit), max(max_distance, self.max_distance)
+            if self.limiter:
+                self.limiter.wait()
+            try:
+                if self.fetch:
+                    similars = self.fetch(track.ratingKey, fetch_limit, fetch_distance)
+                else:
+                    similars = [
+                        (similar.ratingKey, similar.distance)
+                        for similar in track.sonicallySimilar(limit=fetch_limit, maxDistance=fetch_distance)
+                    ]
+            except Exception as e:
+                print(f"Error fetching sonically similar tracks: {e}")
+                similars = []
+            self._lists[track.ratingKey] = (fetch_limit, fetch_distance, similars)
+            self._fetched_at[track.ratingKey] = time.monotonic()
+        similars = self._lists[track.ratingKey][2]
+        return [key for key, distance in similars if distance is None or distance <= max_distance][:limit]
+
+    def neighbors(self, track):
+        """
+        Return {ratingKey: rank} for the track's sonic neighbors.
+        """
+        ranks = self._ranks.get(track.ratingKey)
+        if ranks is not None:
+            with self._lock:
+                self.hits += 1
+        else:
+            ranks = {}
+            for rank, key in enumerate(self.neighbor_keys(track)):
+                ranks.setdefault(key, rank)
+            self._ranks[track.ratingKey] = ranks
+            self._fetched_at.setdefault(track.ratingKey, time.monotonic())
+        return ranks
+
+    def prefetch(self, tracks, workers=1, limit=None, max_distance=None):
+        """
+        Load the neighbor lists of several tracks, in parallel when workers > 1.
+        """
+        limit = self.limit if limit is None else limit
+        max_distance = self.max_distance if max_distance is None else max_distance
+        missing = [track for track in tracks if not self._covers(track.ratingKey, limit, max_distance)]
+        load = partial(self.neighbor_keys, limit=limit, max_distance=max_distance)
+        if workers > 1 and len(missing) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(load, missing))
+        else:
+            for track in missing:
+                load(track)
+
+    def evict_older_than(self, cutoff):
+        for key in [key for key, fetched_at in self._fetched_at.items() if fetched_at < cutoff]:
+            self._lists.pop(key, None)
+            self._ranks.pop(key, None)
+            del self._fetched_at[key]
+
+    def rank(self, current, candidate, default=100):
+        return self.neighbors(current).get(candidate.ratingKey, default)
+
+class SonicFrontier:
+    """
+    Best-first expansion of the sonic neighborhood of the accepted tracks,
+    for topping the playlist up to max_tracks. Each seed is expanded at most
+    once (visited), candidates are ranked by their aggregate similarity to
+    every expanded seed, and nothing more is requested from Plex once
+    request_budget requests (neighbor lists plus candidate batches) are
+    spent. Neighbor lists go through ctx.sonic_graph, so sequencing reuses
+    them.
+    """
+    def __init__(self, ctx, excluded_keys=None, request_budget=100):
+        self.ctx = ctx
+        self.graph = ctx.sonic_graph
+        self.excluded_keys = excluded_keys or set()
+        self.budget = request_budget
+        self.visited = set()
+        self.offered = set()
+        self.scores = Counter()
+
+    def expand(self, tracks):
+        seeds = [track for track in tracks if track.ratingKey not in self.visited]
+        while seeds and self.budget > 0:
+            # Each seed costs at most one request, so a batch never overspends
+            batch, seeds = seeds[:self.budget], seeds[self.budget:]
+            requests_before = self.graph.request_count
+            self.graph.prefetch(batch, self.ctx.fetch_workers)
+            self.budget -= self.graph.request_count - requests_before
+            for track in batch:
+                self.visited.add(track.ratingKey)
+                for key, rank in self.graph.neighbors(track).items():
+                    self.scores[key] += 1.0 / (rank + 1)
+
+    def candidates(self, count, accepted_keys):
+        """
+        Load the count best-scored tracks not offered before, leaving out
+        accepted, excluded and recently played tracks.
+        """
+        ranked = [
+            key for key, _ in self.scores.most_common()
+            if key not in self.offered and key not in accepted_keys and key not in self.excluded_keys
+        ][:count]
+        batch_size = 100
+        ranked = ranked[:max(0, self.budget) * batch_size]
+        if not ranked:
+            return []
+        self.offered.update(ranked)
+        self.budget -= (len(ranked) + batch_size - 1) // batch_size
+        items = fetch_candidate_tracks(self.ctx, ranked, batch_size)
+
+        exclude_start = datetime.now() - timedelta(days=self.ctx.exclude_played_days)
+        candidates = []
+        for key in ranked:
+            track = items.get(key)
+            if track is None:
+                continue
+            last_played = track.lastViewedAt
+            if last_played and last_played >= exclude_start:
+                print(f"EXCLUDED (sonicallySimilar): {track.title} - Last played {last_played}")
+                continue
+            candidates.append(track)
+        return candidates
+
+def build_distance_matrix(tracks, graph, default=100):
+    """
+    Dense, symmetric distance matrix from the graph's neighbor ranks.
+    A pair's distance is the better of the two ranks, or `default` when
+    neither track lists the other as a neighbor.
+    """
+    import numpy as np  # deferred: only needed once sequencing starts
+
+    index = {track.ratingKey: i for i, track in enumerate(tracks)}
+    ranks = np.full((len(tracks), len(tracks)), float(default))
+    for i, track in enumerate(tracks):
+        for key, rank in graph.neighbors(track).items():
+            j = index.get(key)
+            if j is not None:
+                ranks[i, j] = rank
+    np.fill_diagonal(ranks, 0)
+    return np.minimum(ranks, ranks.T)
+
+def path_cost(path, dist):
+    return float(dist[path[:-1], path[1:]].sum())
+
+def two_opt(path, dist, deadline):
+    """
+    Improve a path in place with 2-opt moves, keeping both endpoints fixed.
+    For each i, every segment reversal path[i:j+1] is scored in one
+    vectorized step and the best improving move is applied.
+    """
+    import numpy as np
+
+    n = len(path)
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for i in range(1, n - 2):
+            a, b = path[i - 1], path[i]
+            c, d = path[i + 1:n - 1], path[i + 2:n]
+            delta = dist[a, c] + dist[b, d] - dist[a, b] - dist[c, d]
+            best = int(np.argmin(delta))
+            if delta[best] < -1e-9:
+                j = i + 1 + best
+                path[i:j + 1] = path[i:j + 1][::-1].copy()
+                improved = True
+            if time.monotonic() >= deadline:
+                break
+    return path
+
+def sequence_tracks(first_track, middle_tracks, last_track, graph, time_budget=2.0):
+    """
+    Order the middle tracks between the fixed first and last tracks.
+    The distance matrix is built once from the graph; a greedy
+    nearest-neighbor path is then improved with 2-opt until no move
+    helps or the time budget runs out. No server calls happen after
+    the matrix is built.
+    """
+    import numpy as np
+
+    if len(middle_tracks) < 2:
+        return list(middle_tracks)
+
+    tracks = [first_track] + list(middle_tracks) + [last_track]
+    dist = build_distance_matrix(tracks, graph)
+    deadline = time.monotonic() + time_budget
+
+    # Greedy start from the first track, ties broken by original order
+    last_index = len(tracks) - 1
+    remaining = list(range(1, last_index))
+    path = [0]
     while remaining:
-        next_track = min(
-            remaining,
-            key=lambda candidate: similarity_score(current, candidate, limit, max_distance)
-        )
-        sorted_list.append(next_track)
-        remaining.remove(next_track)
-        current = next_track
-    return sorted_list
+        row = dist[path[-1], remaining]
+        path.append(remaining.pop(int(np.argmin(row))))
+    path = np.array(path + [last_index])
 
-def generate_playlist_title_and_description(period, tracks):
+    path = two_opt(path, dist, deadline)
+    return [tracks[i] for i in path[1:-1]]
+
+def generate_playlist_title_and_description(ctx, period, tracks):
     descriptor_map = load_descriptor_map("moodmap.json")
     day_name = datetime.now().strftime("%A")
 
-    top_genres = [str(g) for t in tracks for g in (t.genres or [])]
-    top_moods = [str(m) for t in tracks for m in (t.moods or [])]
+    load_tags(ctx, tracks)
+    top_genres = [g for t in tracks for g in (t.genres or [])]
+    top_moods = [m for t in tracks for m in (t.moods or [])]
     genre_counts = Counter(top_genres)
     mood_counts = Counter(top_moods)
 
@@ -359,7 +1629,7 @@ def generate_playlist_title_and_description(period, tracks):
     second_common_mood = sorted_moods[1] if len(sorted_moods) > 1 else None
 
     descriptor = random.choice(descriptor_map.get(second_common_mood, ["Vibrant"]))
-    period_phrase = get_period_phrase(period)
+    period_phrase = get_period_phrase(ctx, period)
 
     title = f"Meloday for {most_common_mood} {descriptor} {most_common_genre} {day_name} {period}"
 
@@ -386,43 +1656,81 @@ def generate_playlist_title_and_description(period, tracks):
             f"Here's some {', '.join(highlight_styles[:-1])}, and {highlight_styles[-1]} tracks as well."
         )
 
-    try:
-        plex_account = plex.myPlexAccount()
-        plex_user = plex_account.title.split()[0] if plex_account.title else plex_account.username
-    except Exception:
-        plex_user = "you"
-
-    now = datetime.now()
-    period_hours = time_periods[period]["hours"]
-    last_hour = period_hours[-1]
-    next_update_hour = (last_hour + 1) % 24
-
-    next_update = now.replace(hour=next_update_hour, minute=0, second=0)
-    if next_update_hour < now.hour:
-        next_update += timedelta(days=1)
+    if ctx.plex_user is None:
+        try:
+            plex_account = ctx.plex.myPlexAccount()
+            ctx.plex_user = plex_account.title.split()[0] if plex_account.title else plex_account.username
+        except Exception:
+            ctx.plex_user = "you"
+    plex_user = ctx.plex_user
 
-    next_update_time = next_update.strftime("%I:%M %p").lstrip("0")
+    next_update_time = get_next_update(ctx, period).strftime("%I:%M %p").lstrip("0")
     description += f"\n\nMade for {plex_user} • Next update at {next_update_time}."
     return title, description
 
-def apply_text_to_cover(image_path, text):
+@lru_cache(maxsize=None)
+def load_font(path, size):
+    try:
+        return ImageFont.truetype(path, size=size)
+    except IOError:
+        return ImageFont.load_default()
+
+@lru_cache(maxsize=8)
+def load_cover_image(image_path, mtime_ns):
+    with Image.open(image_path) as image:
+        return image.convert("RGBA")
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def cover_cache_path(ctx, image_path, text):
+    """
+    Path of the rendered cover for this cover file and title text. The key
+    includes the cover's mtime and size so edited assets are re-rendered.
+    """
+    stat = os.stat(image_path)
+    key = "\0".join([
+        os.path.abspath(image_path), str(stat.st_mtime_ns), str(stat.st_size),
+        ctx.font_main_path, ctx.font_meloday_path, text
+    ])
+    name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return os.path.join(ctx.cover_cache_dir, f"{name}.webp")
+
+def prune_cover_cache(ctx, keep=COVER_CACHE_SIZE):
+    try:
+        paths = [os.path.join(ctx.cover_cache_dir, name) for name in os.listdir(ctx.cover_cache_dir)]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for path in paths[keep:]:
+            os.remove(path)
+    except OSError:
+        pass
+
+def apply_text_to_cover(ctx, image_path, text):
+    """
+    Render the title onto the cover. Results are cached in ctx.cover_cache_dir,
+    keyed by the cover file and the title text.
+    """
     try:
         prefix = "Meloday for "
         if text.startswith(prefix):
             text = text[len(prefix):]
 
-        image = Image.open(image_path).convert("RGBA")
-        shadow_layer = Image.new("RGBA", image.size, (0, 0, 0, 0))
+        new_image_path = cover_cache_path(ctx, image_path, text)
+        if os.path.exists(new_image_path):
+            ctx.metrics.count_cache("rendered_covers", hits=1)
+            return new_image_path
+        ctx.metrics.count_cache("rendered_covers", misses=1)
+
+        image = load_cover_image(image_path, os.stat(image_path).st_mtime_ns).copy()
         text_layer = Image.new("RGBA", image.size, (255, 255, 255, 0))
-        shadow_draw = ImageDraw.Draw(shadow_layer)
         text_draw = ImageDraw.Draw(text_layer)
 
-        try:
-            font_main = ImageFont.truetype(FONT_MAIN_PATH, size=67)
-            font_meloday = ImageFont.truetype(FONT_MELODAY_PATH, size=87)
-        except IOError:
-            font_main = ImageFont.load_default()
-            font_meloday = ImageFont.load_default()
+        font_main = load_font(ctx.font_main_path, 67)
+        font_meloday = load_font(ctx.font_meloday_path, 87)
 
         text_box_width = 630
         text_box_right = image.width - 110
@@ -433,59 +1741,212 @@ def apply_text_to_cover(image_path, text):
         shadow_blur = 40
 
         lines = wrap_text(text, font_main, text_draw, text_box_width)
+        placed = []
         for line in lines:
             bbox = text_draw.textbbox((0, 0), line, font=font_main)
             line_width = bbox[2] - bbox[0]
             x = text_box_left + (text_box_width - line_width)
 
-            shadow_draw.text((x + shadow_offset, y + shadow_offset), line, font=font_main, fill=(0, 0, 0, 120))
+            placed.append((x + shadow_offset, y + shadow_offset, line))
             text_draw.text((x, y), line, font=font_main, fill=(255, 255, 255, 255))
             y += bbox[3] - bbox[1] + 10
 
-        shadow_layer = shadow_layer.filter(ImageFilter.GaussianBlur(radius=shadow_blur))
+        # Blur the shadow only around the text; the rest of the layer is empty
+        if placed:
+            boxes = [text_draw.textbbox((x, y), line, font=font_main) for x, y, line in placed]
+            pad = shadow_blur * 3
+            left = max(0, min(box[0] for box in boxes) - pad)
+            top = max(0, min(box[1] for box in boxes) - pad)
+            right = min(image.width, max(box[2] for box in boxes) + pad)
+            bottom = min(image.height, max(box[3] for box in boxes) + pad)
+
+            shadow_region = Image.new("RGBA", (right - left, bottom - top), (0, 0, 0, 0))
+            shadow_draw = ImageDraw.Draw(shadow_region)
+            for x, y, line in placed:
+                shadow_draw.text((x - left, y - top), line, font=font_main, fill=(0, 0, 0, 120))
+            shadow_region = shadow_region.filter(ImageFilter.GaussianBlur(radius=shadow_blur))
+            image.alpha_composite(shadow_region, dest=(left, top))
+
         meloday_x = 110
         meloday_y = image.height - 200
-        shadow_draw.text((meloday_x + shadow_offset, meloday_y + shadow_offset), "Meloday", font=font_meloday, fill=(0, 0, 0, 120))
         text_draw.text((meloday_x, meloday_y), "Meloday", font=font_meloday, fill=(255, 255, 255, 255))
 
-        combined = Image.alpha_composite(image, shadow_layer)
-        combined = Image.alpha_composite(combined, text_layer)
+        combined = Image.alpha_composite(image, text_layer)
 
-        new_image_path = image_path.replace(".webp", "_texted.webp")
+        os.makedirs(ctx.cover_cache_dir, exist_ok=True)
         combined.convert("RGB").save(new_image_path)
+        prune_cover_cache(ctx)
         return new_image_path
     except Exception:
         return image_path
 
-def create_or_update_playlist(name, tracks, description, cover_file):
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+def playlist_period(ctx, title):
+    """
+    The daypart a Meloday playlist title was generated for, or None.
+    Titles end with "<weekday> <period>", so "Morning" never matches an
+    "Early Morning" playlist.
+    """
+    if not title.startswith("Meloday for "):
+        return None
+    for period in ctx.time_periods:
+        if any(title.endswith(f" {day} {period}") for day in WEEKDAYS):
+            return period
+    return None
+
+def find_meloday_playlist(ctx, slot, period=None, claimed=()):
+    """
+    Find the Meloday playlist by its stored ratingKey, falling back to a
+    title scan only when no key is stored or the playlist was deleted.
+    The scan skips playlists whose ratingKey is in claimed (the other
+    slots' playlists). With a period, only a playlist for exactly that
+    daypart matches; without one, any daypart's playlist does.
+    """
+    key = slot.get("key")
+    if key:
+        try:
+            playlist = ctx.plex.fetchItem(int(key))
+            if getattr(playlist, "TYPE", None) == "playlist":
+                return playlist
+        except Exception:
+            pass
+
+    for playlist in ctx.plex.playlists():
+        if playlist.ratingKey in claimed:
+            continue
+        title_period = playlist_period(ctx, playlist.title)
+        if title_period and (not period or title_period == period):
+            return playlist
+    return None
+
+def keys_to_move(current_keys, target_keys):
+    """
+    Return the keys that have to move for current_keys to match target_keys.
+    The longest run of keys already in target order stays where it is.
+    """
+    position = {key: i for i, key in enumerate(target_keys)}
+    positions = [position[key] for key in current_keys]
+
+    # Longest increasing subsequence of target positions (patience sorting)
+    tails, tail_indices, previous = [], [], [None] * len(positions)
+    for i, pos in enumerate(positions):
+        slot = bisect_left(tails, pos)
+        if slot == len(tails):
+            tails.append(pos)
+            tail_indices.append(i)
+        else:
+            tails[slot] = pos
+            tail_indices[slot] = i
+        previous[i] = tail_indices[slot - 1] if slot else None
+
+    keep = set()
+    i = tail_indices[-1] if tail_indices else None
+    while i is not None:
+        keep.add(current_keys[i])
+        i = previous[i]
+    return {key for key in current_keys if key not in keep}
+
+def remove_playlist_entries(playlist, entries):
+    """
+    Delete playlist entries by their own playlistItemID. plexapi's
+    removeItems matches entries by ratingKey, so both copies of a
+    duplicated track resolve to the first entry and the second delete fails.
+    """
+    for entry in entries:
+        playlist._server.query(
+            f"{playlist.key}/items/{entry.playlistItemID}", method=playlist._server._session.delete
+        )
+
+def sync_playlist_items(playlist, tracks):
+    """
+    Bring the playlist in line with tracks using only the removals, additions
+    and moves that are needed, instead of rewriting every item.
+    """
+    target_keys = list(dict.fromkeys(t.ratingKey for t in tracks))
+    tracks_by_key = {t.ratingKey: t for t in tracks}
+    current = playlist.items()
+    current_keys = [item.ratingKey for item in current]
+    if len(set(current_keys)) != len(current_keys):
+        # Duplicate entries can't be told apart by ratingKey; rewrite instead
+        remove_playlist_entries(playlist, current)
+        playlist.addItems([tracks_by_key[key] for key in target_keys])
+        return
+
+    target_set = set(target_keys)
+    stale = [item for item in current if item.ratingKey not in target_set]
+    if stale:
+        playlist.removeItems(stale)
+
+    kept_keys = [key for key in current_keys if key in target_set]
+    kept_set = set(kept_keys)
+    missing_keys = [key for key in target_keys if key not in kept_set]
+    if missing_keys:
+        playlist.addItems([tracks_by_key[key] for key in missing_keys])
+        playlist.reload()
+
+    moves = keys_to_move(kept_keys + missing_keys, target_keys)
+    if not moves:
+        return
+    items_by_key = {item.ratingKey: item for item in playlist.items()}
+    previous_key = None
+    for key in target_keys:
+        if key in moves:
+            after = items_by_key[previous_key] if previous_key is not None else None
+            playlist.moveItem(items_by_key[key], after=after)
+        previous_key = key
+
+def create_or_update_playlist(ctx, name, tracks, description, cover_file, period=None):
+    """
+    Create or update the Meloday playlist. By default there is a single
+    playlist; with a period, each daypart gets a playlist of its own.
+    Returns False if the playlist could not be written.
+    """
     try:
-        existing_playlist = None
-        for playlist in plex.playlists():
-            if playlist.title.startswith("Meloday for "):
-                existing_playlist = playlist
-                break
+        state = load_state(ctx)
+        slots = state.setdefault("playlists", {})
+        slot = slots.setdefault(period or "current", {})
+        claimed = {other.get("key") for other in slots.values() if other is not slot}
+        existing_playlist = find_meloday_playlist(ctx, slot, period, claimed)
 
         valid_tracks = [t for t in tracks if hasattr(t, "ratingKey")]
         if existing_playlist:
-            existing_playlist.removeItems(existing_playlist.items())
-            existing_playlist.addItems(valid_tracks)
+            if ctx.playlist_sync_mode == "diff":
+                sync_playlist_items(existing_playlist, valid_tracks)
+            else:
+                remove_playlist_entries(existing_playlist, existing_playlist.items())
+                existing_playlist.addItems(valid_tracks)
             existing_playlist.editTitle(name)
             existing_playlist.editSummary(description)
         else:
-            existing_playlist = plex.createPlaylist(name, items=valid_tracks)
+            existing_playlist = ctx.plex.createPlaylist(name, items=valid_tracks)
             existing_playlist.editSummary(description)
 
-        cover_path = os.path.join(COVER_IMAGE_DIR, cover_file)
+        if slot.get("key") != existing_playlist.ratingKey:
+            slot.clear()
+            slot["key"] = existing_playlist.ratingKey
+            save_state(ctx, state)
+
+        cover_path = os.path.join(ctx.cover_image_dir, cover_file)
         if os.path.exists(cover_path):
-            new_cover = apply_text_to_cover(cover_path, name)
-            existing_playlist.uploadPoster(filepath=new_cover)
-    except Exception:
-        pass
+            new_cover = apply_text_to_cover(ctx, cover_path, name)
+            poster_hash = file_hash(new_cover)
+            if slot.get("poster_hash") != poster_hash:
+                ctx.metrics.count_cache("poster_upload", misses=1)
+                existing_playlist.uploadPoster(filepath=new_cover)
+                slot["poster_hash"] = poster_hash
+                save_state(ctx, state)
+            else:
+                ctx.metrics.count_cache("poster_upload", hits=1)
+    except Exception as e:
+        print(f"Error creating/updating playlist: {e}")
+        return False
+    return True
 
-def find_first_and_last_tracks(tracks, period):
+def find_first_and_last_tracks(ctx, tracks, period):
     if not tracks:
         return None, None
-    valid_hours = set(time_periods[period]["hours"])
+    valid_hours = set(ctx.time_periods[period]["hours"])
     sorted_tracks = sorted(
         tracks,
         key=lambda t: t.lastViewedAt if hasattr(t, "lastViewedAt") and t.lastViewedAt else datetime.max
@@ -499,69 +1960,212 @@ def find_first_and_last_tracks(tracks, period):
     return first_track, last_track
 
 # ---------------------------------------------------------------------
-def main():
-    # Step 0% - Start
-    print_status(0, "Starting track selection...")
-
-    period = get_current_time_period()
-    print_status(10, f"Current time period: {period}")
-
+def build_playlist_tracks(ctx, period, history):
+    """
+    Select, filter and order the tracks for one daypart.
+    """
     # Step 1: Fetch historical
     print_status(20, "Fetching historical tracks...")
-    historical, excluded_keys = fetch_historical_tracks(period)
+    with ctx.metrics.stage("historical_tracks"):
+        historical, excluded_keys = fetch_historical_tracks(ctx, period, history)
 
     # Guarantee ~30% historical
-    guaranteed_count = int(MAX_TRACKS * 0.3)
+    guaranteed_count = int(ctx.max_tracks * 0.3)
     guaranteed_historical = random.sample(historical, min(guaranteed_count, len(historical)))
 
     # Step 2: Fetch similar
     print_status(30, "Fetching sonically similar tracks...")
-    similar = fetch_sonically_similar_tracks(guaranteed_historical, excluded_keys=excluded_keys)
+    with ctx.metrics.stage("similar_tracks"):
+        similar = fetch_sonically_similar_tracks(ctx, guaranteed_historical, excluded_keys=excluded_keys)
 
     # Combine
     print_status(40, "Combining & processing tracks...")
     all_tracks = guaranteed_historical + similar
-    final_tracks = process_tracks(all_tracks)
-
-    # Step 3: Ensure we reach MAX_TRACKS
+    with ctx.metrics.stage("process_tracks"):
+        final_tracks = process_tracks(ctx, all_tracks, limit=ctx.max_tracks, excluded_keys=excluded_keys)
+
+    # Step 3: Ensure we reach max_tracks by expanding the sonic neighborhood
+    # of the accepted tracks; the seeds of step 2 were already queried
+    frontier = SonicFrontier(ctx, excluded_keys, ctx.expansion_request_budget)
+    frontier.visited.update(t.ratingKey for t in guaranteed_historical)
+    guaranteed_keys = {t.ratingKey for t in guaranteed_historical}
+    spare_historical = [t for t in historical if t.ratingKey not in guaranteed_keys]
     progress_step = 40
-    while len(final_tracks) < MAX_TRACKS:
-        progress_step += 5
+    while len(final_tracks) < ctx.max_tracks:
+        progress_step = min(progress_step + 5, 65)
         print_status(progress_step, f"Attempting to add more tracks...")
 
-        more_historical, more_excluded = fetch_historical_tracks(period)
-        excluded_keys |= more_excluded
-        leftover_count = MAX_TRACKS - len(final_tracks)
-        leftover_historical = random.sample(more_historical, min(leftover_count, len(more_historical)))
+        with ctx.metrics.stage("top_up"):
+            leftover_count = ctx.max_tracks - len(final_tracks)
+            leftover_historical = random.sample(spare_historical, min(leftover_count, len(spare_historical)))
+            leftover_keys = {t.ratingKey for t in leftover_historical}
+            spare_historical = [t for t in spare_historical if t.ratingKey not in leftover_keys]
 
-        more_similar = fetch_sonically_similar_tracks(final_tracks, excluded_keys=excluded_keys)
-        additional_tracks = process_tracks(leftover_historical + more_similar)
-        final_tracks.extend(additional_tracks[:leftover_count])
+            frontier.expand(final_tracks)
+            # Ask for more than needed: some candidates fail dedup, caps or ratings
+            more_similar = frontier.candidates(2 * leftover_count, {t.ratingKey for t in final_tracks})
+            if not leftover_historical and not more_similar:
+                break
 
-        if not additional_tracks:
-            break
+            # Accepted tracks pass again unchanged and keep new ones from duplicating them
+            final_tracks = process_tracks(
+                ctx, final_tracks + leftover_historical + more_similar,
+                limit=ctx.max_tracks, excluded_keys=excluded_keys
+            )
 
     print_status(70, "Finding first & last historical tracks...")
-    first_track, last_track = find_first_and_last_tracks(final_tracks[:MAX_TRACKS], period)
-    middle_tracks = [t for t in final_tracks[:MAX_TRACKS] if t not in {first_track, last_track}]
-
-    # Step 4: Sonic sort (GREEDY)
-    if middle_tracks:
-        print_status(80, "Performing GREEDY sonic sort...")
-        middle_tracks = sort_by_sonic_similarity_greedy(middle_tracks)
+    first_track, last_track = find_first_and_last_tracks(ctx, final_tracks[:ctx.max_tracks], period)
+    middle_tracks = [t for t in final_tracks[:ctx.max_tracks] if t not in {first_track, last_track}]
+
+    # Step 4: Sonic sequencing between the fixed first and last tracks
+    if middle_tracks and first_track and last_track:
+        print_status(80, "Sequencing tracks by sonic similarity...")
+        requests_before = ctx.sonic_graph.request_count
+        with ctx.metrics.stage("sequencing"):
+            middle_tracks = sequence_tracks(
+                first_track, middle_tracks, last_track, ctx.sonic_graph, ctx.sequencing_time_budget
+            )
+        requests_made = ctx.sonic_graph.request_count - requests_before
+        print_status(85, f"Sonic sequencing used {requests_made} sonicallySimilar requests")
 
-    final_ordered_tracks = (
+    return (
         [first_track] + middle_tracks + [last_track]
-        if first_track and last_track else final_tracks[:MAX_TRACKS]
+        if first_track and last_track else final_tracks[:ctx.max_tracks]
     )
 
-    print_status(90, "Creating/Updating playlist...")
-    title, description = generate_playlist_title_and_description(period, final_ordered_tracks)
-    create_or_update_playlist(title, final_ordered_tracks, description, time_periods[period]['cover'])
+def generate_playlists(ctx, periods, all_periods, manifest):
+    """
+    Fetch the history and build and upload the playlist of every period,
+    then save the run manifest with the final ratingKeys. If a playlist
+    could not be written, the manifest is dropped instead, so the next run
+    does not skip.
+    """
+    with ctx.metrics.stage("history"):
+        history = fetch_play_history(ctx)
+
+    manifest["tracks"] = {}
+    written = True
+    for period in periods:
+        if all_periods:
+            print(f"--- {period} ---")
+        final_ordered_tracks = build_playlist_tracks(ctx, period, history)
+
+        print_status(90, "Creating/Updating playlist...")
+        with ctx.metrics.stage("title"):
+            title, description = generate_playlist_title_and_description(ctx, period, final_ordered_tracks)
+        with ctx.metrics.stage("playlist"):
+            written &= create_or_update_playlist(
+                ctx, title, final_ordered_tracks, description, ctx.time_periods[period]['cover'],
+                period if all_periods else None
+            )
+        manifest["tracks"][period] = [t.ratingKey for t in final_ordered_tracks]
+
+    state = load_state(ctx)
+    if written:
+        state["manifest"] = manifest
+    else:
+        state.pop("manifest", None)
+    save_state(ctx, state)
 
     # Step 5: Done
     print_status(100, "Playlist creation/update complete!")
 
+def main(ctx=None, all_periods=False, force=False):
+    """
+    Build the playlist for the current daypart, or with all_periods one
+    playlist per daypart. History is fetched once, and the sonic-neighbor
+    and rating caches on ctx and the tracks loaded during the run are
+    shared by every period. Unless force, a run that finds the previous
+    run's manifest unchanged (same dayparts before the same boundary, no
+    new plays, same config and seed) stops after one history request.
+    Per-stage metrics are written to metrics.path at the end of the run.
+    """
+    if ctx is None:
+        ctx = MelodayContext.from_config_file()
+    ctx.metrics.reset()
+    ctx.track_records.clear()
+    ctx.searched_tracks.clear()
+    caches_before = cache_counters(ctx)
+
+    # Step 0% - Start
+    print_status(0, "Starting track selection...")
+    if ctx.random_seed is not None:
+        random.seed(ctx.random_seed)
+
+    if all_periods:
+        periods = list(ctx.time_periods)
+        print_status(10, f"Building playlists for {len(periods)} time periods")
+    else:
+        periods = [get_current_time_period(ctx)]
+        print_status(10, f"Current time period: {periods[0]}")
+
+    ctx.metrics.periods = periods
+
+    with ctx.metrics.stage("manifest"):
+        manifest = run_manifest(ctx, periods)
+        previous = load_state(ctx).get("manifest")
+    if ctx.skip_unchanged and not force and manifest_unchanged(previous, manifest):
+        print_status(100, "No new plays since the last run, the playlist is up to date.")
+    else:
+        generate_playlists(ctx, periods, all_periods, manifest)
+
+    caches_after = cache_counters(ctx)
+    for name, (hits, misses) in caches_after.items():
+        hits_before, misses_before = caches_before[name]
+        ctx.metrics.count_cache(name, hits - hits_before, misses - misses_before)
+    record = ctx.metrics.record(http_pool_stats(ctx._plex))
+    print_metrics(record)
+    write_metrics(ctx, record)
+
+def run_daemon(ctx, all_periods=False):
+    """
+    Stay resident and regenerate the playlist at every daypart boundary.
+    The Plex connection and in-memory caches are reused between cycles;
+    cache entries older than daemon.cache_ttl_minutes are evicted.
+    """
+    while True:
+        try:
+            main(ctx, all_periods)
+        except Exception as e:
+            print(f"Error generating playlist: {e}")
+
+        ctx.evict_expired()
+        next_update = get_next_update(ctx, get_current_time_period(ctx))
+        print(f"Next update at {next_update:%Y-%m-%d %H:%M}")
+        time.sleep(max(0.0, (next_update - datetime.now()).total_seconds()) + 1)
+
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Create or update the Meloday playlist for the current time of day.")
+    parser.add_argument(
+        "--daemon", action="store_true",
+        help="keep running and regenerate the playlist at every daypart boundary"
+    )
+    parser.add_argument(
+        "--all-periods", action="store_true",
+        help="build one playlist for every time period in a single pass"
+    )
+    parser.add_argument(
+        "--build-index", action="store_true",
+        help="index the sonic neighbors of tracks added or updated since the last build, then exit"
+    )
+    parser.add_argument(
+        "--rebuild-index", action="store_true",
+        help="index the sonic neighbors of the whole library from scratch, then exit"
+    )
+    parser.add_argument(
+        "--force", action="store_true",
+        help="regenerate the playlist even if nothing changed since the last run"
+    )
+    args = parser.parse_args()
+
+    ctx = MelodayContext.from_config_file()
+    try:
+        if args.build_index or args.rebuild_index:
+            build_sonic_index(ctx, full=args.rebuild_index)
+        elif args.daemon:
+            run_daemon(ctx, args.all_periods)
+        else:
+            main(ctx, args.all_periods, args.force)
+    except KeyboardInterrupt:
+        pass